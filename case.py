@@ -1,32 +1,297 @@
 import os
 import json
+import shlex
 import shutil
 import random
 import string
-import docker
+import math
 import asyncio
-import aiohttp
+import tempfile
+import logging
+import threading
 from io import BytesIO
 from zipfile import ZipFile
 import msg_types
 
 from errors import *
+from cpuset import CpuAllocator, format_cpulist
+from docker_api import DockerClient, STDOUT, STDERR, parse_time
+from metrics import Timings
 from ie import estimate_async, SolutionError
 
 IMAGE_NAME = 'carp_judge'
 TMP_DIR = '/tmp/carp_judge'
 SANDBOX_TMP_DIR = '/workspace'
+# Default bytes kept of each of stdout and stderr
+LOG_LIMIT = 256 * 1024
+# Seconds to wait for the last logs after the container stops
+LOG_DRAIN_TIME = 5
+# Script run by pooled containers, written into the workspace of the case
+POOL_LAUNCHER = os.path.join(SANDBOX_TMP_DIR, 'run.sh')
+# Buffer size when copying files out of archives
+COPY_BUFFER = 1024 * 1024
 
 if not os.path.exists(TMP_DIR):
     os.makedirs(TMP_DIR, exist_ok=True)
 
-_docker_client = docker.from_env()
+docker_client = DockerClient()
+# CPUs handed to containers, none until discover() is called
+cpu_allocator = CpuAllocator()
 
 
 def id_generator(size=8, chars=string.ascii_letters + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
 
 
+class FileCache:
+    '''
+    Files extracted from archives, stored once per content under directory
+    and hard linked into case workspaces, which must be on the same file
+    system. Files are keyed by their CRC-32 and size in the archive, which
+    the extraction checks. Beyond max_bytes, the least recently used files
+    are removed; workspaces linking them keep their copy.
+    '''
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, zipfile, info):
+        '''
+        Returns the path of the cached content of an archive member.
+        '''
+        path = os.path.join(self.directory, '{:08x}-{}'.format(info.CRC, info.file_size))
+        try:
+            os.utime(path)
+            self.hits += 1
+            return path
+        except FileNotFoundError:
+            pass
+        self.misses += 1
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                with zipfile.open(info) as file:
+                    shutil.copyfileobj(file, outfile, COPY_BUFFER)
+            # Shared by workspaces, never written again
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self._evict(path)
+        return path
+
+    def link(self, zipfile, info, outpath):
+        '''
+        Puts the content of an archive member at outpath.
+        '''
+        path = self.get(zipfile, info)
+        try:
+            os.link(path, outpath)
+        except FileNotFoundError:
+            # Evicted in the meantime
+            with open(outpath, 'wb') as outfile, zipfile.open(info) as file:
+                shutil.copyfileobj(file, outfile, COPY_BUFFER)
+        except OSError:
+            shutil.copyfile(path, outpath)
+
+    def _evict(self, keep):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+data_cache = FileCache(os.path.join(TMP_DIR, 'data_cache'))
+
+
+def container_config(command, cpu, memory, workspace, stdout=True, stderr=True, cpus=None):
+    '''
+    Engine API config of a sandbox container running command, a list of
+    arguments, with workspace mounted read-only at SANDBOX_TMP_DIR, and
+    pinned to cpus if given.
+    '''
+    config = {
+        'Image': IMAGE_NAME,
+        'Cmd': command,
+        'WorkingDir': os.path.join(SANDBOX_TMP_DIR, 'program'),
+        'AttachStdout': stdout,
+        'AttachStderr': stderr,
+        'StopSignal': 'SIGKILL',
+        'HostConfig': {
+            'AutoRemove': False,
+            'ReadonlyRootfs': True,
+            'NanoCpus': cpu * 1000000000,
+            'Memory': memory * 1024 * 1024,
+            'MemorySwap': int(memory * 1.5) * 1024 * 1024,
+            'PidsLimit': 64,
+            'NetworkMode': 'none',
+            'Binds': ['{}:{}:ro'.format(workspace, SANDBOX_TMP_DIR)],
+            'Tmpfs': {
+                '/tmp': 'rw,size=1g',
+                '/run': 'rw,size=1g'
+            },
+            'LogConfig': {
+                'Type': 'json-file',
+                'Config': {
+                    'mode': 'non-blocking',
+                    'max-size': '1m',
+                    'max-file': '2'
+                }
+            }
+        }
+    }
+    if cpus:
+        config['HostConfig']['CpusetCpus'] = format_cpulist(cpus)
+    return config
+
+
+class ContainerPool:
+    '''
+    Created, not yet started containers, shapes[(cpu, memory)] of each
+    shape, so that cases of those shapes do not wait for a container to be
+    created. A pooled container mounts an empty workspace and runs
+    POOL_LAUNCHER from it, both filled in by the case taking it. Taken
+    containers are replaced in the background, and like any other are
+    used once and removed.
+    '''
+    def __init__(self, shapes=None):
+        self.shapes = shapes or {}
+        self._idle = {}
+        self._filling = set()
+
+    def take(self, cpu, memory):
+        '''
+        Returns (container id, workspace) of an idle container of the shape,
+        or None.
+        '''
+        shape = (cpu, memory)
+        if shape not in self.shapes:
+            return None
+        asyncio.ensure_future(self.fill(shape))
+        idle = self._idle.get(shape)
+        if not idle:
+            return None
+        return idle.pop(0)
+
+    async def fill(self, shape=None):
+        '''
+        Creates containers until every shape, or the given one, has its
+        count of idle containers.
+        '''
+        if shape is None:
+            for shape in list(self.shapes):
+                await self.fill(shape)
+            return
+        if shape in self._filling:
+            return
+        self._filling.add(shape)
+        try:
+            idle = self._idle.setdefault(shape, [])
+            while len(idle) < self.shapes.get(shape, 0):
+                workspace = os.path.join(TMP_DIR, id_generator())
+                os.makedirs(workspace)
+                try:
+                    config = container_config(['/bin/sh', POOL_LAUNCHER], shape[0], shape[1], workspace)
+                    idle.append((await docker_client.create(config), workspace))
+                except BaseException:
+                    shutil.rmtree(workspace, ignore_errors=True)
+                    raise
+        except SandboxError as e:
+            logging.error('Container pool: {}'.format(e))
+        finally:
+            self._filling.discard(shape)
+
+    async def close(self):
+        '''
+        Removes the idle containers.
+        '''
+        idle = [container for containers in self._idle.values() for container in containers]
+        self._idle = {}
+        for container_id, workspace in idle:
+            try:
+                await docker_client.remove(container_id, force=True)
+            except SandboxError:
+                pass
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    def stats(self):
+        return {'{}x{}'.format(*shape): len(idle) for shape, idle in self._idle.items()}
+
+
+container_pool = ContainerPool()
+
+
+class BoundedLog:
+    '''
+    Output of a stream keeping its first head bytes, by default a quarter of
+    limit, and its last limit - head bytes in a ring buffer. When bytes in
+    between are dropped, getvalue() marks where with a line.
+    '''
+    def __init__(self, limit=LOG_LIMIT, head=None):
+        self.head_limit = limit // 4 if head is None else head
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray(self.tail_limit)
+        self.end = 0
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data or not self.tail_limit:
+            return
+        data = data[-self.tail_limit:]
+        pos = self.end % self.tail_limit
+        first = min(len(data), self.tail_limit - pos)
+        self.tail[pos:pos + first] = data[:first]
+        self.tail[:len(data) - first] = data[first:]
+        self.end += len(data)
+
+    @property
+    def overflow(self):
+        return self.total > self.head_limit + self.tail_limit
+
+    def getvalue(self):
+        if self.end <= self.tail_limit:
+            tail = self.tail[:self.end]
+        else:
+            pos = self.end % self.tail_limit
+            tail = self.tail[pos:] + self.tail[:pos]
+        separator = b''
+        if self.overflow:
+            separator = '\n[... {} bytes skipped ...]\n'.format(
+                self.total - self.head_limit - self.tail_limit).encode()
+        return bytes(self.head + separator + tail)
+
+
 class CARPCase:
     def __init__(self, zip_data, cid=0, ctype=msg_types.CARP, dataset=json.loads('{}')):
         self.cid = cid
@@ -39,6 +304,15 @@ class CARPCase:
         self._stderr = b''
         self._timedout = False
         self._statuscode = -1
+        self._cpus = None
+        self.stdout_overflow = False
+        self.stderr_overflow = False
+        self.flooded = False
+        # Accounting of the container, None when unknown, see _collect_stats()
+        self.usage = {'cpu_user': None, 'cpu_system': None, 'wall_time': None, 'peak_memory': None,
+                      'oom_killed': None}
+        self.imp_report = {}
+        self.timings = Timings()
 
     def __enter__(self):
         # Load data
@@ -108,15 +382,17 @@ class CARPCase:
             new_path = os.path.join(self._tempdir, item)
             # check dir or not
             if item[-1] == '/':
-                os.makedirs(new_path)
+                os.makedirs(new_path, exist_ok=True)
                 continue
             outpath = os.path.join(self._tempdir, item)
             os.makedirs(os.path.dirname(outpath), exist_ok=True)
+            if item.startswith('data/'):
+                # Same for every submission of a task
+                data_cache.link(zipfile, zipfile.getinfo(item), outpath)
+                continue
             with open(outpath, 'wb') as outfile:
                 with zipfile.open(item) as file:
-                    data = file.read()
-                    data.replace(b'\r', b'')
-                    outfile.write(data)
+                    shutil.copyfileobj(file, outfile, COPY_BUFFER)
         # Prepare arguments
         if self.data:
             self.parameters = self.parameters.replace('$data', os.path.join(SANDBOX_TMP_DIR, 'data', self.data))
@@ -136,85 +412,188 @@ class CARPCase:
         return self
 
     async def _wait_container(self):
-        with aiohttp.UnixConnector('/var/run/docker.sock') as conn:
-            timeout = aiohttp.ClientTimeout(total=self.time)
-            async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
-                async with session.post('http://localhost/containers/{}/wait'.format(self._container.id)) as resp:
-                    try:
-                        return False, await resp.json()
-                    except asyncio.TimeoutError:
-                        return True, None
-
-    async def run(self, stdout=True, stderr=True):
-        if self._container is not None:
-            raise SandboxError('Container already exists!')
-        # Build command
-        command = 'python3 {program} {parameters}'.format(
+        try:
+            return False, await docker_client.wait(self._container, timeout=self.time)
+        except asyncio.TimeoutError:
+            return True, None
+
+    def _move_workspace(self, workspace):
+        '''
+        Moves the extracted files into the workspace of a pooled container
+        and writes the launcher it runs.
+        '''
+        for item in os.listdir(self._tempdir):
+            os.rename(os.path.join(self._tempdir, item), os.path.join(workspace, item))
+        shutil.rmtree(self._tempdir, ignore_errors=True)
+        self._tempdir = workspace
+        with open(os.path.join(workspace, os.path.basename(POOL_LAUNCHER)), 'w') as file:
+            file.write('exec {}\n'.format(' '.join(shlex.quote(arg) for arg in shlex.split(self._command()))))
+
+    def _command(self):
+        return 'python3 {program} {parameters}'.format(
             program=os.path.join(SANDBOX_TMP_DIR, 'program', self.entry),
             parameters=self.parameters
         )
-        self._container = _docker_client.containers.run(
-            image=IMAGE_NAME,
-            command=command,
-            name=self.cid,
-            auto_remove=False,
-            detach=True,
-            read_only=True,
-            nano_cpus=self.cpu * 1000000000,
-            mem_limit=str(self.memory) + 'm',
-            memswap_limit=str(int(self.memory * 1.5)) + 'm',
-            pids_limit=64,
-            network_mode='none',
-            stop_signal='SIGKILL',
-            volumes={self._tempdir: {'bind': SANDBOX_TMP_DIR, 'mode': 'ro'}},
-            working_dir=os.path.join(SANDBOX_TMP_DIR, 'program'),
-            tmpfs={
-                '/tmp': 'rw,size=1g',
-                '/run': 'rw,size=1g'
-            },
-            stdout=stdout,
-            stderr=stderr,
-            log_config={
-                'config': {
-                    'mode': 'non-blocking',
-                    'max-size': '1m',
-                    'max-file': '2'
-                }
-            }
-        )
-        timedout, response = await self._wait_container()
-        statuscode = -1
-        if timedout:
-            try:
-                self._container.kill()
-            except:
-                pass
+
+    async def _capture_logs(self, logs, flood_bytes, flood_rate):
+        '''
+        Streams the logs of the running container into logs, and kills it
+        once it has written more than flood_bytes in total or more than
+        flood_rate bytes per second over a second.
+        '''
+        loop = asyncio.get_event_loop()
+        total = 0
+        window_start = loop.time()
+        window_bytes = 0
+        async for stream, data in docker_client.follow_logs(self._container, STDOUT in logs, STDERR in logs):
+            logs[stream].write(data)
+            total += len(data)
+            window_bytes += len(data)
+            now = loop.time()
+            flooded = flood_bytes is not None and total > flood_bytes
+            if now - window_start >= 1:
+                flooded |= flood_rate is not None and window_bytes / (now - window_start) > flood_rate
+                window_start = now
+                window_bytes = 0
+            if flooded:
+                self.flooded = True
+                try:
+                    await docker_client.kill(self._container)
+                except SandboxError:
+                    pass
+                return
+
+    async def _collect_stats(self):
+        '''
+        Follows the stats of the running container, keeping the CPU seconds
+        it used in user and kernel mode and the peak of its resident memory
+        in bytes. Both are sampled about every second, so the last second
+        of CPU time and short memory peaks may be missed.
+
+        The stream does not end when the container exits, it is cancelled
+        once the container is waited for.
+        '''
+        try:
+            async for stats in docker_client.stats(self._container):
+                # Empty samples of a stopped container
+                if parse_time(stats.get('read')) is None:
+                    continue
+                cpu = stats.get('cpu_stats', {}).get('cpu_usage', {})
+                if 'usage_in_usermode' in cpu:
+                    self.usage['cpu_user'] = max(self.usage['cpu_user'] or 0., cpu['usage_in_usermode'] / 1e9)
+                    self.usage['cpu_system'] = max(self.usage['cpu_system'] or 0.,
+                                                   cpu['usage_in_kernelmode'] / 1e9)
+                memory = stats.get('memory_stats', {})
+                details = memory.get('stats', {})
+                # rss with cgroup v1, anon with cgroup v2
+                rss = details.get('rss', details.get('anon', memory.get('usage')))
+                if rss is not None:
+                    self.usage['peak_memory'] = max(self.usage['peak_memory'] or 0, rss)
+        except SandboxError as e:
+            logging.warning('No stats of {}: {}'.format(self._container, e))
+
+    async def _collect_state(self):
+        '''
+        Reads the wall time from start to exit and whether the kernel killed
+        the container for running out of memory, before it is removed.
+        '''
+        try:
+            state = (await docker_client.inspect(self._container))['State']
+        except (SandboxError, KeyError, TypeError) as e:
+            logging.warning('No state of {}: {}'.format(self._container, e))
+            return
+        self.usage['oom_killed'] = state.get('OOMKilled')
+        started = parse_time(state.get('StartedAt'))
+        finished = parse_time(state.get('FinishedAt'))
+        if started is not None and finished is not None:
+            self.usage['wall_time'] = max(finished - started, 0.)
+
+    async def run(self, stdout=True, stderr=True, log_limit=LOG_LIMIT, flood_bytes=None, flood_rate=None):
+        '''
+        Runs the program in a new container. Logs are streamed while it
+        runs, keeping the head and tail of each stream within log_limit
+        bytes, see BoundedLog. With flood_bytes or flood_rate, the container
+        is killed once its output exceeds them, and flooded is set. The
+        resources it used are kept in usage.
+        '''
+        if self._container is not None:
+            raise SandboxError('Container already exists!')
+        # Released once the container is removed
+        self._cpus = cpu_allocator.allocate(self.cpu_count)
+        if self._cpus is None and cpu_allocator.topology:
+            logging.warning('No {} free CPUs to pin case {} to, running it unpinned'.format(self.cpu_count,
+                                                                                            self.cid))
+        pooled = container_pool.take(self.cpu, self.memory)
+        if pooled is not None:
+            self._container, workspace = pooled
         else:
-            statuscode = response['StatusCode']
+            config = container_config(shlex.split(self._command()), self.cpu, self.memory, self._tempdir,
+                                      stdout, stderr, self._cpus)
+            with self.timings.phase('create'):
+                self._container = await docker_client.create(config, name=str(self.cid) if self.cid else None)
+        logs = {}
         if stdout:
-            _stdout = self._container.logs(
-                stdout=True,
-                stderr=False
-            )
-        else:
-            _stdout = b''
+            logs[STDOUT] = BoundedLog(log_limit)
         if stderr:
-            _stderr = self._container.logs(
-                stdout=False,
-                stderr=True
-            )
-        else:
-            _stderr = b''
+            logs[STDERR] = BoundedLog(log_limit)
+        capture = None
+        stats = None
+        try:
+            with self.timings.phase('start'):
+                if pooled is not None:
+                    self._move_workspace(workspace)
+                    if self._cpus:
+                        await docker_client.update(self._container, {'CpusetCpus': format_cpulist(self._cpus)})
+                await docker_client.start(self._container)
+            stats = asyncio.ensure_future(self._collect_stats())
+            if logs:
+                capture = asyncio.ensure_future(self._capture_logs(logs, flood_bytes, flood_rate))
+            with self.timings.phase('run'):
+                timedout, response = await self._wait_container()
+            stats.cancel()
+            statuscode = -1
+            if timedout:
+                try:
+                    await docker_client.kill(self._container)
+                except SandboxError:
+                    pass
+            else:
+                statuscode = response['StatusCode']
+            # The log stream ends soon after the container stops
+            with self.timings.phase('drain'):
+                if capture is not None:
+                    await asyncio.wait([capture], timeout=LOG_DRAIN_TIME)
+                await self._collect_state()
+            if capture is not None and capture.done():
+                capture.result()
+        finally:
+            for task in (capture, stats):
+                if task is not None:
+                    task.cancel()
+            # Containers are used once, remove it even if cancelled
+            with self.timings.phase('remove'):
+                await self._remove_container()
+            self._release_cpus()
+        _stdout = logs[STDOUT].getvalue() if stdout else b''
+        _stderr = logs[STDERR].getvalue() if stderr else b''
+        self.stdout_overflow = stdout and logs[STDOUT].overflow
+        self.stderr_overflow = stderr and logs[STDERR].overflow
         self._stdout = _stdout
         self._stderr = _stderr
         self._timedout = timedout
         self._statuscode = statuscode
         return timedout, _stdout, _stderr, statuscode
 
-    async def check_imp_result(self):
+    async def check_imp_result(self, engine='python', progress=None, **options):
+        '''
+        Scores the seeds printed by an IMP submission. progress and options
+        are passed on to estimate_async(), the full scoring report is kept in
+        imp_report.
+        '''
         if self._timedout:
             return False, 0., 'Timed out'
-        if self._statuscode == 137:
+        oom_killed = self.usage['oom_killed']
+        if oom_killed or (oom_killed is None and self._statuscode == 137):
             return False, 0., 'Killed (Out of memory)'
         if self._statuscode != 0:
             return False, 0., 'Exit code is not zero'
@@ -227,18 +606,35 @@ class CARPCase:
         result = 0.
         valid = False
         try:
-            result = await estimate_async(network, stdout, seed_count, model=self.model)
+            self.imp_report = await estimate_async(network, stdout, seed_count, model=self.model, engine=engine,
+                                                   report=True, progress=progress, **options)
+            result = self.imp_report['influence']
             valid = True
             reason = 'Solution accepted'
         except SolutionError as err:
             reason = err.get_reason()
         return valid, result, reason
 
-    def close(self):
+    async def _remove_container(self):
         try:
-            self._container.remove(force=True)
-        except:
+            await docker_client.remove(self._container, force=True)
+        except SandboxError:
             pass
+
+    @property
+    def cpu_count(self):
+        '''
+        Whole CPUs the container is pinned to.
+        '''
+        return max(1, math.ceil(self.cpu))
+
+    def _release_cpus(self):
+        if self._cpus:
+            cpu_allocator.release(self._cpus)
+            self._cpus = None
+
+    def close(self):
+        self._release_cpus()
         shutil.rmtree(self._tempdir, ignore_errors=True)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -1,8 +1,33 @@
 import asyncio
+import base64
+import json
+import os
+import shutil
+import pickle
+import struct
+import tempfile
+import time
 import unittest
+import aiohttp
+from aiohttp import web
 import msg_types
-from case import CARPCase
-from ie import estimate, estimate_async, SolutionError
+import case
+from case import CARPCase, BoundedLog, FileCache
+from zipfile import ZipFile
+from io import BytesIO
+from docker_api import DOCKER_SOCKET, DockerClient, demux, parse_time
+from errors import SandboxError
+from scheduler import Scheduler
+from cpuset import CpuAllocator, format_cpulist, parse_cpulist, read_topology
+from metrics import Histogram, Gauge, Registry, Timings, phase_seconds
+from protocol import MSGPACK_PROTOCOL, JsonCodec, MsgpackCodec, subprotocols, get_codec, case_archive
+import websockets
+from io import StringIO
+import ie
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import ie_bench
+from ie import estimate, estimate_async, network_cache, read_network, read_seed, parse_network, start_pool, shutdown_pool, NetworkCache, ScoreCache, Sampler, SolutionError
 
 
 class TestAPlusBCase(unittest.TestCase):
@@ -187,5 +212,921 @@ class TestISESync(unittest.TestCase):
             
         self.assertAlmostEqual(result, 19.2, places=1)
 
+class DockerStandIn:
+    '''
+    Stand-in of the Docker Engine API on a unix socket, recording calls.
+    Containers c1, c2... exit with status 3 after printing 35 to stdout
+    and e to stderr, having run for 1.5 seconds and used 2 seconds of CPU.
+    Waiting for them takes run_time seconds. With stats_open, their stats
+    stream goes on with empty samples after they exit, as Docker does until
+    they are removed.
+    '''
+    STATS = [
+        {'read': '2018-10-01T08:00:00.5Z',
+         'cpu_stats': {'cpu_usage': {'usage_in_usermode': 500000000, 'usage_in_kernelmode': 100000000}},
+         'memory_stats': {'usage': 9000000, 'stats': {'anon': 4000000}}},
+        {'read': '2018-10-01T08:00:01.5Z',
+         'cpu_stats': {'cpu_usage': {'usage_in_usermode': 1500000000, 'usage_in_kernelmode': 500000000}},
+         'memory_stats': {'usage': 8000000, 'stats': {'anon': 3000000}}}
+    ]
+    EMPTY_STATS = {'read': '0001-01-01T00:00:00Z',
+                   'cpu_stats': {'cpu_usage': {'usage_in_usermode': 0, 'usage_in_kernelmode': 0}},
+                   'memory_stats': {}}
+    STATE = {'Status': 'exited', 'ExitCode': 3, 'OOMKilled': False, 'StartedAt': '2018-10-01T08:00:00.25Z',
+             'FinishedAt': '2018-10-01T08:00:01.750000001Z'}
+    def __init__(self, loop, run_time=0.1, stats_open=False):
+        self.loop = loop
+        self.run_time = run_time
+        # Actions answered after a second
+        self.slow = set()
+        # Bytes printed to stdout when following logs, in 1 KB frames
+        self.flood = 0
+        self.stats_open = stats_open
+        self.path = os.path.join(tempfile.mkdtemp(), 'docker.sock')
+        self.calls = []
+        self.containers = {}
+        app = web.Application()
+        app.router.add_post('/{version}/containers/create', self.create)
+        app.router.add_route('*', '/{version}/containers/{id}/{action}', self.action)
+        app.router.add_delete('/{version}/containers/{id}', self.action)
+        self.runner = web.AppRunner(app)
+        loop.run_until_complete(self.runner.setup())
+        loop.run_until_complete(web.UnixSite(self.runner, self.path).start())
+
+    async def create(self, request):
+        config = await request.json()
+        cid = 'c{}'.format(len(self.containers) + 1)
+        self.containers[cid] = config
+        self.calls.append(('create', request.query.get('name'), config['Image']))
+        return web.json_response({'Id': cid}, status=201)
+
+    async def action(self, request):
+        action = request.match_info.get('action', 'remove')
+        self.calls.append((action, request.match_info['id']))
+        if action in self.slow:
+            await asyncio.sleep(1)
+        if request.match_info['id'] not in self.containers:
+            return web.json_response({'message': 'No such container'}, status=404)
+        if action == 'wait':
+            await asyncio.sleep(self.run_time)
+            return web.json_response({'StatusCode': 3})
+        if action == 'logs' and self.flood and request.query.get('follow') == '1':
+            return await self.flood_logs(request)
+        if action == 'logs':
+            return web.Response(body=struct.pack('>BxxxL', 1, 3) + b'35\n' + struct.pack('>BxxxL', 2, 2) + b'e\n')
+        if action == 'stats':
+            return await self.stats(request)
+        if action == 'json':
+            return web.json_response({'Id': request.match_info['id'], 'State': self.STATE})
+        return web.Response(status=204)
+
+    async def flood_logs(self, request):
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        try:
+            for i in range(self.flood // 1024):
+                await resp.write(struct.pack('>BxxxL', 1, 1024) + b'x' * 1024)
+                await asyncio.sleep(0.001)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        return resp
+
+    async def stats(self, request):
+        if not self.stats_open:
+            return web.Response(body=''.join(json.dumps(stats) + '\n' for stats in self.STATS).encode())
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        try:
+            for stats in self.STATS:
+                await resp.write(json.dumps(stats).encode() + b'\n')
+            await asyncio.sleep(self.run_time)
+            # Until the client goes away, or for at most 10 seconds
+            for i in range(200):
+                await resp.write(json.dumps(self.EMPTY_STATS).encode() + b'\n')
+                await asyncio.sleep(0.05)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        return resp
+
+    def close(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+
+
+class TestDockerClient(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.docker = DockerStandIn(self.loop)
+        self.calls = self.docker.calls
+        self.client = DockerClient(self.docker.path)
+
+    def test_run(self):
+        async def run_main():
+            cid = await self.client.create({'Image': 'carp_judge'}, name='case')
+            await self.client.start(cid)
+            self.assertEqual({'StatusCode': 3}, await self.client.wait(cid, timeout=5))
+            self.assertEqual((b'35\n', b'e\n'), await self.client.logs(cid))
+            pieces = [piece async for piece in self.client.follow_logs(cid, chunk_size=2)]
+            self.assertEqual([(1, b'35'), (1, b'\n'), (2, b'e\n')], pieces)
+            self.assertEqual(DockerStandIn.STATS, [stats async for stats in self.client.stats(cid)])
+            self.assertEqual(DockerStandIn.STATE, (await self.client.inspect(cid))['State'])
+            await self.client.remove(cid)
+            with self.assertRaises(SandboxError):
+                await self.client.kill('c2')
+        self.loop.run_until_complete(run_main())
+        self.assertEqual([('create', 'case', 'carp_judge'), ('start', 'c1'), ('wait', 'c1'), ('logs', 'c1'),
+                          ('logs', 'c1'), ('stats', 'c1'), ('json', 'c1'), ('remove', 'c1'), ('kill', 'c2')],
+                         self.calls)
+
+    def test_timeout(self):
+        client = DockerClient(self.docker.path, timeout=0.1)
+        self.docker.slow = {'kill', 'remove'}
+        self.docker.run_time = 0.5
+        async def run_main():
+            cid = await client.create({'Image': 'carp_judge'})
+            # Other calls than wait fail like any other Docker error
+            with self.assertRaises(SandboxError):
+                await client.kill(cid)
+            with self.assertRaises(SandboxError):
+                await client.remove(cid)
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.wait(cid, timeout=0.1)
+            await client.close()
+        self.loop.run_until_complete(run_main())
+
+    def test_demux(self):
+        data = struct.pack('>BxxxL', 2, 1) + b'a' + struct.pack('>BxxxL', 1, 2) + b'bc' + struct.pack('>BxxxL', 2, 1)
+        self.assertEqual((b'bc', b'ad'), demux(data + b'd'))
+
+    def test_parse_time(self):
+        self.assertEqual(1538380800.5, parse_time('2018-10-01T08:00:00.500000000Z'))
+        self.assertEqual(1538380800, parse_time('2018-10-01T08:00:00Z'))
+        self.assertIsNone(parse_time('0001-01-01T00:00:00Z'))
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.client.close())
+        self.docker.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
+class TestContainerPool(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.docker = DockerStandIn(self.loop)
+        case.docker_client.socket_path = self.docker.path
+        case.container_pool.shapes = {(8, 256): 1}
+        with open('./examples/data_example.zip', 'rb') as zipfile:
+            self.case = CARPCase(zipfile.read()).__enter__()
+
+    def test_run(self):
+        async def run_main():
+            await case.container_pool.fill()
+            self.assertEqual({'8x256': 1}, case.container_pool.stats())
+            timedout, stdout, stderr, exitcode = await self.case.run()
+            self.assertEqual((False, b'35\n', b'e\n', 3), (timedout, stdout, stderr, exitcode))
+            self.assertEqual({'cpu_user': 1.5, 'cpu_system': 0.5, 'wall_time': 1.5, 'peak_memory': 4000000,
+                              'oom_killed': False}, {key: round(value, 6) if isinstance(value, float) else value
+                                                     for key, value in self.case.usage.items()})
+            # Replaced in the background
+            await asyncio.sleep(0.1)
+            self.assertEqual({'8x256': 1}, case.container_pool.stats())
+        self.loop.run_until_complete(run_main())
+        self.assertEqual(['/bin/sh', case.POOL_LAUNCHER], self.docker.containers['c1']['Cmd'])
+        with open(os.path.join(self.case._tempdir, 'run.sh')) as file:
+            self.assertEqual('exec python3 /workspace/program/aplusb.py /workspace/data/test.dat -t 10 -c 8 -m 256\n',
+                             file.read())
+        self.assertTrue(os.path.exists(os.path.join(self.case._tempdir, 'data', 'test.dat')))
+        self.assertIn(('remove', 'c1'), self.docker.calls)
+
+    def tearDown(self):
+        self.case.close()
+        self.loop.run_until_complete(case.container_pool.close())
+        self.assertIn(('remove', 'c2'), self.docker.calls)
+        case.container_pool.shapes = {}
+        self.loop.run_until_complete(case.docker_client.close())
+        case.docker_client.socket_path = DOCKER_SOCKET
+        self.docker.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
+class TestUsage(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # The stats stream stays open after the container exits
+        self.docker = DockerStandIn(self.loop, run_time=0.2, stats_open=True)
+        case.docker_client.socket_path = self.docker.path
+        with open('./examples/data_example.zip', 'rb') as zipfile:
+            self.case = CARPCase(zipfile.read()).__enter__()
+
+    def test_run(self):
+        start = time.monotonic()
+        self.loop.run_until_complete(self.case.run())
+        # Not waiting for the stats stream to end
+        self.assertLess(time.monotonic() - start, case.LOG_DRAIN_TIME)
+        # Nor overwritten by empty samples
+        self.assertAlmostEqual(1.5, self.case.usage['cpu_user'])
+        self.assertAlmostEqual(0.5, self.case.usage['cpu_system'])
+        self.assertEqual(4000000, self.case.usage['peak_memory'])
+        self.assertIn(('remove', 'c1'), self.docker.calls)
+
+    def test_flood(self):
+        self.docker.flood = 1024 * 1024
+        timedout, stdout, stderr, exitcode = self.loop.run_until_complete(
+            self.case.run(log_limit=4096, flood_bytes=16 * 1024))
+        self.assertTrue(self.case.flooded)
+        self.assertIn(('kill', 'c1'), self.docker.calls)
+        # Killed long before printing it all
+        self.assertTrue(self.case.stdout_overflow)
+        self.assertIn(b'bytes skipped ...]\n', stdout)
+        self.assertLess(len(stdout), 4096 + 64)
+
+    def test_cpus(self):
+        allocator = case.cpu_allocator
+        case.cpu_allocator = CpuAllocator({0: (0, 0, 0), 1: (0, 0, 1), 2: (0, 0, 2)})
+        try:
+            self.case.cpu = 1.5
+            self.assertEqual(2, self.case.cpu_count)
+            self.loop.run_until_complete(self.case.run())
+            self.assertEqual('0,1', self.docker.containers['c1']['HostConfig']['CpusetCpus'])
+            # Free for the next case before this one closes
+            self.assertEqual({0, 1, 2}, case.cpu_allocator.free)
+        finally:
+            case.cpu_allocator = allocator
+
+    def tearDown(self):
+        self.case.close()
+        self.loop.run_until_complete(case.docker_client.close())
+        case.docker_client.socket_path = DOCKER_SOCKET
+        self.docker.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
+class TestBoundedLog(unittest.TestCase):
+    def test_write(self):
+        log = BoundedLog(8, head=3)
+        log.write(b'ab')
+        self.assertEqual(b'ab', log.getvalue())
+        log.write(b'cdef')
+        self.assertEqual(b'abcdef', log.getvalue())
+        self.assertFalse(log.overflow)
+        log.write(b'ghij')
+        self.assertEqual(b'abc\n[... 2 bytes skipped ...]\nfghij', log.getvalue())
+        log.write(b'0123456789')
+        self.assertEqual(b'abc\n[... 12 bytes skipped ...]\n56789', log.getvalue())
+        self.assertTrue(log.overflow)
+        self.assertEqual(20, log.total)
+        # Overflowing with the first write past the head
+        log = BoundedLog(8, head=3)
+        log.write(b'abc0123456789')
+        self.assertTrue(log.overflow)
+        self.assertEqual(b'abc\n[... 5 bytes skipped ...]\n56789', log.getvalue())
+
+
+class TestFileCache(unittest.TestCase):
+    def test_link(self):
+        directory = tempfile.mkdtemp()
+        cache = FileCache(os.path.join(directory, 'cache'), max_bytes=1500)
+        archive = BytesIO()
+        with ZipFile(archive, 'w') as zipfile:
+            zipfile.writestr('a', b'a' * 1000)
+            zipfile.writestr('b', b'b' * 1000)
+        zipfile = ZipFile(archive)
+        cache.link(zipfile, zipfile.getinfo('a'), os.path.join(directory, 'a1'))
+        cache.link(zipfile, zipfile.getinfo('a'), os.path.join(directory, 'a2'))
+        self.assertEqual({'hits': 1, 'misses': 1}, cache.stats())
+        self.assertTrue(os.path.samefile(os.path.join(directory, 'a1'), os.path.join(directory, 'a2')))
+        # a is evicted, the workspaces keep it
+        cache.link(zipfile, zipfile.getinfo('b'), os.path.join(directory, 'b1'))
+        self.assertEqual(1, len(os.listdir(cache.directory)))
+        with open(os.path.join(directory, 'a2'), 'rb') as file:
+            self.assertEqual(b'a' * 1000, file.read())
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def test_admit(self):
+        order = []
+        async def run(scheduler, name, cpus, memory, hold):
+            async with scheduler.admit(cpus, memory):
+                order.append(name)
+                await asyncio.sleep(hold)
+        async def run_main(max_wait):
+            scheduler = Scheduler(8, 4096, max_wait)
+            tasks = [asyncio.ensure_future(run(scheduler, 'a', 6, 1024, 0.1))]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.ensure_future(run(scheduler, 'big', 8, 1024, 0)))
+            await asyncio.sleep(0.01)
+            tasks.append(asyncio.ensure_future(run(scheduler, 'small', 2, 1024, 0)))
+            await asyncio.sleep(0.01)
+            self.assertEqual({'freeCpu': 2, 'freeMemory': 3072, 'waiting': 1 if max_wait else 2},
+                             scheduler.stats())
+            await asyncio.gather(*tasks)
+            self.assertEqual({'freeCpu': 8, 'freeMemory': 4096, 'waiting': 0}, scheduler.stats())
+        # The small case backfills around the big one
+        self.loop.run_until_complete(run_main(60))
+        self.assertEqual(['a', 'small', 'big'], order)
+        # Unless the big one waited too long
+        del order[:]
+        self.loop.run_until_complete(run_main(0))
+        self.assertEqual(['a', 'big', 'small'], order)
+
+    def test_cancel(self):
+        async def run_main():
+            scheduler = Scheduler(4, 1024)
+            await scheduler.acquire(4, 100)
+            waiting = asyncio.ensure_future(scheduler.acquire(2, 100))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            scheduler.release(4, 100)
+            # More than there is runs alone
+            await scheduler.acquire(16, 100)
+            self.assertEqual({'freeCpu': 0, 'freeMemory': 924, 'waiting': 0}, scheduler.stats())
+        self.loop.run_until_complete(run_main())
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        histogram = registry.register(Histogram('phase_seconds', 'Phases', ('phase',), buckets=(0.1, 1)))
+        gauge = registry.register(Gauge('queue_depth', 'Queues', ('queue',)))
+        histogram.observe(0.05, 'run')
+        histogram.observe(0.5, 'run')
+        histogram.observe(2, 'run')
+        queue = [1, 2, 3]
+        gauge.set_function(lambda: len(queue), 'judge')
+        gauge.set(1, 'send')
+        queue.pop()
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE phase_seconds histogram', lines)
+        self.assertIn('phase_seconds_bucket{phase="run",le="0.1"} 1', lines)
+        self.assertIn('phase_seconds_bucket{phase="run",le="1.0"} 2', lines)
+        self.assertIn('phase_seconds_bucket{phase="run",le="+Inf"} 3', lines)
+        self.assertIn('phase_seconds_sum{phase="run"} 2.55', lines)
+        self.assertIn('phase_seconds_count{phase="run"} 3', lines)
+        # Sampled when rendered
+        self.assertIn('queue_depth{queue="judge"} 2.0', lines)
+        self.assertIn('queue_depth{queue="send"} 1.0', lines)
+
+    def test_serve(self):
+        loop = asyncio.new_event_loop()
+        registry = Registry()
+        registry.register(Gauge('up', 'Up')).set(1)
+        async def run_main():
+            runner = await registry.serve('127.0.0.1', 0)
+            try:
+                port = runner.addresses[0][1]
+                async with aiohttp.ClientSession() as session:
+                    async with session.get('http://127.0.0.1:{}/metrics'.format(port)) as resp:
+                        return await resp.text()
+            finally:
+                await runner.cleanup()
+        try:
+            self.assertIn('up 1.0\n', loop.run_until_complete(run_main()))
+        finally:
+            loop.close()
+
+    def test_timings(self):
+        timings = Timings()
+        count = phase_seconds._series.get(('extract',), ([0], 0))[0][-1]
+        with timings.phase('extract'):
+            time.sleep(0.01)
+        timings.add('extract', 1)
+        self.assertGreaterEqual(timings.phases['extract'], 1.01)
+        self.assertEqual(count + 2, phase_seconds._series[('extract',)][0][-1])
+
+
+class JudgeServerStandIn:
+    '''
+    Stand-in of the judge server websocket, speaking msgpack when protocols
+    has it. It sends a case to each worker connecting, and keeps the frame
+    type and message of each reply.
+    '''
+    def __init__(self, loop, archive, protocols=()):
+        self.loop = loop
+        self.archive = archive
+        self.received = []
+        app = web.Application()
+        app.router.add_get('/api/websocket', self.handle)
+        self.runner = web.AppRunner(app)
+        loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        self.url = 'ws://127.0.0.1:{}/api/websocket'.format(self.runner.addresses[0][1])
+        self.protocols = protocols
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse(protocols=self.protocols)
+        await ws.prepare(request)
+        codec = get_codec(ws.ws_protocol)
+        data = self.archive if codec.binary else base64.b64encode(self.archive).decode()
+        payload = {'cid': 'c1', 'type': msg_types.IMP, 'data': data, 'dataset': {'network': '4 2\n1 2 0.5\n'}}
+        message = codec.encode({'type': msg_types.CASE_DATA, 'payload': payload})
+        if codec.binary:
+            await ws.send_bytes(message)
+        else:
+            await ws.send_str(message)
+        async for message in ws:
+            binary = message.type == aiohttp.WSMsgType.BINARY
+            self.received.append((binary, codec.decode(message.data)))
+        return ws
+
+    def close(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+
+
+class TestProtocol(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        with open('./examples/data_imp.zip', 'rb') as zipfile:
+            self.archive = zipfile.read()
+
+    def round_trip(self, protocols, binary):
+        server = JudgeServerStandIn(self.loop, self.archive, protocols)
+        result = {'cid': 'c1', 'type': msg_types.CASE_RESULT, 'stdout': '35\n\u00e9', 'exitcode': 0,
+                  'influence': 1.5, 'interval': [1.25, 1.75], 'timings': {'run': 0.5}}
+        async def run_main():
+            async with websockets.connect(server.url, subprotocols=subprotocols(binary)) as ws:
+                codec = get_codec(ws.subprotocol)
+                obj = codec.decode(await ws.recv())
+                self.assertEqual(msg_types.CASE_DATA, obj['type'])
+                self.assertEqual(self.archive, case_archive(obj['payload']))
+                self.assertEqual('4 2\n1 2 0.5\n', obj['payload']['dataset']['network'])
+                await ws.send(codec.encode(result))
+                return codec
+        try:
+            codec = self.loop.run_until_complete(run_main())
+            # Let the server read the reply
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+        finally:
+            server.close()
+        self.assertEqual([(codec.binary, result)], server.received)
+        return codec
+
+    def test_msgpack(self):
+        self.assertIs(MsgpackCodec, self.round_trip((MSGPACK_PROTOCOL,), True))
+
+    def test_fallback(self):
+        # The server does not know msgpack
+        self.assertIs(JsonCodec, self.round_trip((), True))
+        # The worker does not offer it
+        self.assertIs(JsonCodec, self.round_trip((MSGPACK_PROTOCOL,), False))
+
+    def tearDown(self):
+        self.loop.close()
+
+
+class TestCpuAllocator(unittest.TestCase):
+    def setUp(self):
+        # Two nodes of two cores of two threads, 0 and 4 being siblings
+        self.sysfs = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.sysfs, 'cpu'))
+        with open(os.path.join(self.sysfs, 'cpu', 'online'), 'w') as file:
+            file.write('0-7\n')
+        for node, cpus in enumerate(('0-1,4-5', '2-3,6-7')):
+            os.makedirs(os.path.join(self.sysfs, 'node', 'node{}'.format(node)))
+            with open(os.path.join(self.sysfs, 'node', 'node{}'.format(node), 'cpulist'), 'w') as file:
+                file.write(cpus + '\n')
+        for cpu in range(8):
+            directory = os.path.join(self.sysfs, 'cpu', 'cpu{}'.format(cpu), 'topology')
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'physical_package_id'), 'w') as file:
+                file.write(str(cpu % 4 // 2))
+            with open(os.path.join(directory, 'core_id'), 'w') as file:
+                file.write(str(cpu % 2))
+
+    def test_allocate(self):
+        self.assertEqual([0, 1, 2, 3], parse_cpulist('0-1,2,3\n'))
+        topology = read_topology(self.sysfs, range(16))
+        self.assertEqual(8, len(topology))
+        self.assertEqual((1, 1, 0), topology[6])
+        allocator = CpuAllocator(topology)
+        self.assertEqual({0, 4}, allocator.allocate(2))
+        # The sibling of a single CPU is used before a whole core
+        self.assertEqual({1}, allocator.allocate(1))
+        self.assertEqual({5}, allocator.allocate(1))
+        self.assertEqual({2, 3, 6, 7}, allocator.allocate(4))
+        self.assertIsNone(allocator.allocate(1))
+        allocator.release({1, 5})
+        self.assertEqual('1,5', format_cpulist(allocator.allocate(2)))
+        self.assertIsNone(CpuAllocator().allocate(1))
+
+
+class TestGraph(unittest.TestCase):
+    def test_csr(self):
+        graph = read_network(StringIO('3 4\n10 20 0.5\n10 30 0.25\n30 20 1\n10 20 0.5\n'))
+        self.assertEqual(3, graph.vnum)
+        self.assertEqual(3, graph.enum)
+        (v10, v20, v30), missing = graph.index([10, 20, 30])
+        self.assertFalse(missing.any())
+        out = graph.target[graph.offset[v10]:graph.offset[v10 + 1]]
+        self.assertEqual(sorted([v20, v30]), sorted(out.tolist()))
+        into = graph.in_source[graph.in_offset[v20]:graph.in_offset[v20 + 1]]
+        self.assertEqual(sorted([v10, v30]), sorted(into.tolist()))
+        self.assertEqual(sorted([v10, v30]), sorted(graph.nonactive.tolist()))
+
+    def test_parse(self):
+        with open('./examples/network.txt', 'rb') as network:
+            dataset = network.read()
+        graph = parse_network(dataset)
+        self.assertEqual((62, 159), (graph.vnum, graph.enum))
+        # Blank lines and extra columns take the line by line path
+        other = parse_network(dataset.decode('utf8').replace('\n', ' 0\n\n'))
+        self.assertEqual(graph.target.tolist(), other.target.tolist())
+        self.assertEqual(graph.weight.tolist(), other.weight.tolist())
+        self.assertRaises(ValueError, parse_network, '1 1\n1.5 2 0.5\n')
+
+    def test_seeds(self):
+        with open('./examples/network.txt', 'r') as network:
+            graph = read_network(network)
+        self.assertEqual(graph.index([56, 58, 38])[0].tolist(), read_seed(StringIO('56\n58\n38\n'), 3, graph))
+        for seeds, reason in [('56\n58\nx\n', 'Vaule Error! Not int.'),
+                              ('56\n999\nx\n', 'Node not in the network.'),
+                              ('56\n58\n', 'Wrong number of seeds')]:
+            with self.assertRaises(SolutionError) as context:
+                read_seed(StringIO(seeds), 3, graph)
+            self.assertEqual(reason, context.exception.get_reason())
+
+    def test_share(self):
+        with open('./examples/network.txt', 'r') as network:
+            graph = read_network(network)
+        target = graph.target.copy()
+        graph.share()
+        try:
+            self.assertTrue(os.path.exists(graph.path))
+            copy = pickle.loads(pickle.dumps(graph))
+            self.assertEqual(target.tolist(), copy.target.tolist())
+            self.assertFalse(copy.target.flags.writeable)
+            self.assertLess(len(pickle.dumps(graph)), 1024)
+        finally:
+            graph.close()
+        self.assertIsNone(graph.path)
+
+    def test_estimate(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        self.assertAlmostEqual(21.52, estimate(dataset, seedset, 3, model='IC'), delta=0.3)
+        self.assertAlmostEqual(24.21, estimate(dataset, seedset, 3, model='LT'), delta=0.3)
+
+
+class TestNetworkCache(unittest.TestCase):
+    def test_cache(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        other = dataset.replace('0.25', '0.3')
+        cache = NetworkCache(1024 * 1024)
+        graph = cache.get(dataset)
+        self.assertIs(graph, cache.get(dataset))
+        self.assertEqual({'hits': 1, 'misses': 1, 'graphs': 1}, {k: v for k, v in cache.stats().items() if k != 'bytes'})
+        cache.release(graph)
+        cache.release(graph)
+        # Over budget, the least recently used graph is evicted but stays valid until released
+        cache.max_bytes = 1
+        in_use = cache.get(dataset)
+        cache.release(cache.get(other))
+        self.assertEqual(1, cache.stats()['graphs'])
+        self.assertTrue(os.path.exists(in_use.path))
+        cache.release(in_use)
+        self.assertIsNone(in_use.path)
+        cache.clear()
+
+
+class TestScoreCache(unittest.TestCase):
+    def test_estimate(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        report = estimate(dataset, '56\n58\n38', 3, r=2000, random_seed='cache', report=True)
+        self.assertFalse(report['cached'])
+        # Same seed set in another order
+        cached = estimate(dataset, '38\n56\n58\n', 3, r=2000, random_seed='cache', report=True)
+        self.assertTrue(cached['cached'])
+        self.assertEqual(report['influence'], cached['influence'])
+        self.assertFalse(estimate(dataset, '38\n56\n58', 3, r=3000, random_seed='cache', report=True)['cached'])
+        self.assertFalse(estimate(dataset, '38\n56\n58', 3, r=2000, random_seed='cache', model='LT', report=True)['cached'])
+
+    def test_disk(self):
+        path = os.path.join(tempfile.mkdtemp(), 'scores.db')
+        cache = ScoreCache(memory_entries=1, path=path, disk_entries=2)
+        for key in 'abc':
+            cache.put(key, {'influence': ord(key)})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual({'influence': ord('b')}, cache.get('b'))
+        # A new process sees the same scores
+        self.assertEqual({'influence': ord('c')}, ScoreCache(path=path).get('c'))
+
+    def test_version(self):
+        graph = parse_network('3 2\n1 2 0.5\n2 3 0.5\n')
+        key = ScoreCache.key(graph, 'IC', 'python', [0, 1], 'cache')
+        version = ScoreCache.version
+        ScoreCache.version += 1
+        try:
+            # Scores of other samples are not served
+            self.assertNotEqual(key, ScoreCache.key(graph, 'IC', 'python', [0, 1], 'cache'))
+        finally:
+            ScoreCache.version = version
+
+
+class TestAdaptiveSampling(unittest.TestCase):
+    def test_estimate(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        report = estimate(dataset, seedset, 3, report=True)
+        self.assertEqual(10000, report['samples'])
+        report = estimate(dataset, seedset, 3, tolerance=0.1, r_min=500, r_max=50000, report=True)
+        low, high = report['interval']
+        self.assertLessEqual(high - low, 0.2)
+        self.assertTrue(500 <= report['samples'] < 50000)
+        self.assertAlmostEqual(21.52, report['influence'], delta=0.3)
+        report = estimate(dataset, seedset, 3, tolerance=0.001, r_min=500, r_max=2000, report=True)
+        self.assertEqual(2000, report['samples'])
+
+
+class TestRandomStreams(unittest.TestCase):
+    def test_estimate(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        for engine in ('python', 'numpy'):
+            results = [estimate(dataset, seedset, 3, multiprocess=n, engine=engine, r=3000, cache=False) for n in (1, 2, 5)]
+            self.assertEqual(1, len(set(results)))
+            self.assertEqual(3000, estimate(dataset, seedset, 3, multiprocess=7, engine=engine, r=3000, report=True, cache=False)['samples'])
+
+    def test_sampler(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        graph = network_cache.get(dataset)
+        try:
+            for engine in ('python', 'numpy'):
+                for model in ('IC', 'LT'):
+                    sampler = Sampler(graph, model, None, None, 'sustech', engine)
+                    sampler.prepare()
+                    samples = sampler.single_sample([1, 2], 1000)
+                    self.assertEqual(samples[300:600], sampler.single_sample([1, 2], 300, 300))
+        finally:
+            network_cache.release(graph)
+
+
+class TestBatchSampler(unittest.TestCase):
+    def test_estimate(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        result = estimate(dataset, seedset, 3, model='IC', engine='numpy')
+        self.assertAlmostEqual(21.52, result, delta=0.3)
+        result = estimate(dataset, '56\n58', 2, model='IC', engine='numpy')
+        self.assertAlmostEqual(19.2, result, delta=0.3)
+        result = estimate(dataset, seedset, 3, model='LT', engine='numpy')
+        self.assertAlmostEqual(24.21, result, delta=0.3)
+
+
+class TestLiveEdgeIndex(unittest.TestCase):
+    def setUp(self):
+        # Away from the indexes of a running worker
+        self.index_dir = ie.INDEX_DIR
+        ie.INDEX_DIR = tempfile.mkdtemp()
+
+    def test_estimate(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        result = estimate(dataset, seedset, 3, model='IC', engine='index')
+        self.assertAlmostEqual(21.52, result, delta=0.3)
+        # Same samples every time
+        self.assertEqual(result, estimate(dataset, seedset, 3, model='IC', engine='index', multiprocess=1, cache=False))
+        result = estimate(dataset, seedset, 3, model='LT', engine='index')
+        self.assertAlmostEqual(24.21, result, delta=0.3)
+
+    def test_breakdown(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        for model in ('IC', 'LT'):
+            report = estimate(dataset, '56\n58\n38', 3, model=model, engine='index', report=True, breakdown=True)
+            self.assertEqual(report['influence'], estimate(dataset, '56\n58\n38', 3, model=model, engine='index'))
+            self.assertEqual([38, 56, 58], [seed['seed'] for seed in report['breakdown']])
+            for seed, others in zip(report['breakdown'], ('56\n58', '38\n58', '38\n56')):
+                alone = estimate(dataset, str(seed['seed']), 1, model=model, engine='index')
+                self.assertAlmostEqual(alone, seed['influence'])
+                without = estimate(dataset, others, 2, model=model, engine='index')
+                self.assertAlmostEqual(report['influence'] - without, seed['marginal'])
+                self.assertAlmostEqual(alone - seed['marginal'], seed['overlap'])
+        with self.assertRaises(ValueError):
+            estimate(dataset, '56\n58\n38', 3, engine='numpy', breakdown=True)
+        # The int32 hits and owner of a batch stay within the buffer size too
+        graph = parse_network(dataset)
+        sampler = ie.IndexSampler(graph, ie.LiveEdgeIndex.build(graph, 'IC', 10, numpy.random.default_rng(1)))
+        self.assertLessEqual(sampler.breakdown_batch * 9 * graph.vnum, sampler.buffer_size)
+        self.assertEqual(sampler.batch // 9, sampler.breakdown_batch)
+
+    def test_build_steps(self):
+        with open('./examples/network.txt', 'r') as network:
+            graph = parse_network(network.read())
+        buffer_size = ie.LiveEdgeIndex.buffer_size
+        try:
+            for model in ('IC', 'LT'):
+                ie.LiveEdgeIndex.buffer_size = 1 << 24
+                large = ie.LiveEdgeIndex.build(graph, model, 100, numpy.random.default_rng(7)).bits
+                # One sample per step
+                ie.LiveEdgeIndex.buffer_size = 1
+                small = ie.LiveEdgeIndex.build(graph, model, 100, numpy.random.default_rng(7)).bits
+                self.assertTrue(numpy.array_equal(large, small))
+        finally:
+            ie.LiveEdgeIndex.buffer_size = buffer_size
+
+    def test_build_once(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        build = ie.LiveEdgeIndex.build
+        builds = []
+        def slow_build(*args):
+            builds.append(args)
+            time.sleep(0.2)
+            return build(*args)
+        ie.LiveEdgeIndex.build = slow_build
+        graph = network_cache.get(dataset)
+        try:
+            with ThreadPoolExecutor(2) as executor:
+                indexes = list(executor.map(lambda i: ie.load_index(graph, 'IC', 100, 1), range(2)))
+            self.assertEqual(1, len(builds))
+            self.assertEqual(indexes[0].path, indexes[1].path)
+        finally:
+            network_cache.release(graph)
+            ie.LiveEdgeIndex.build = build
+
+    def test_too_large(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        max_bytes = ie.INDEX_MAX_BYTES
+        ie.INDEX_MAX_BYTES = 1024
+        try:
+            with self.assertWarns(UserWarning):
+                report = estimate(dataset, '56\n58\n38', 3, engine='index', r=2000, report=True, breakdown=True,
+                                  cache=False)
+            # Scored with the numpy engine instead of building the index
+            self.assertEqual(estimate(dataset, '56\n58\n38', 3, engine='numpy', r=2000, cache=False),
+                             report['influence'])
+            self.assertNotIn('breakdown', report)
+            self.assertEqual([], os.listdir(ie.INDEX_DIR))
+        finally:
+            ie.INDEX_MAX_BYTES = max_bytes
+
+    def test_evict(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        max_bytes = ie.INDEX_MAX_BYTES
+        try:
+            graph = network_cache.get(dataset)
+            try:
+                first = ie.load_index(graph, 'IC', 1000, 1)
+                # Room for two indexes
+                ie.INDEX_MAX_BYTES = os.path.getsize(first.path) * 2
+                second = ie.load_index(graph, 'IC', 1000, 2)
+                os.utime(first.path, (0, 0))
+                ie.use_index(second)
+                ie.evict_indexes()
+                self.assertEqual(2, len(os.listdir(ie.INDEX_DIR)))
+                # The least recently used goes, unless in use
+                third = ie.load_index(graph, 'IC', 1000, 3)
+                ie.use_index(third)
+                ie.evict_indexes()
+                self.assertFalse(os.path.exists(first.path))
+                fourth = ie.load_index(graph, 'IC', 1000, 4)
+                ie.use_index(fourth)
+                ie.evict_indexes()
+                self.assertEqual({second.path, third.path, fourth.path},
+                                 {entry.path for entry in os.scandir(ie.INDEX_DIR)})
+                for index in (second, third, fourth):
+                    ie.release_index(index)
+                ie.evict_indexes()
+                self.assertEqual(2, len(os.listdir(ie.INDEX_DIR)))
+            finally:
+                network_cache.release(graph)
+        finally:
+            ie.INDEX_MAX_BYTES = max_bytes
+
+    def tearDown(self):
+        shutil.rmtree(ie.INDEX_DIR, ignore_errors=True)
+        ie.INDEX_DIR = self.index_dir
+
+
+class TestScoringPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = start_pool(2)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def test_run(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        async def run_main():
+            results = await asyncio.gather(
+                estimate_async(dataset, seedset, 3, model='IC'),
+                estimate_async(dataset, seedset, 3, model='LT', engine='numpy')
+            )
+            self.assertIs(self.pool, start_pool())
+            self.assertAlmostEqual(21.52, results[0], delta=0.3)
+            self.assertAlmostEqual(24.21, results[1], delta=0.3)
+        self.loop.run_until_complete(run_main())
+
+    def test_chunks(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        # Same samples as estimate() whatever order the chunks finish in
+        for engine in ('python', 'numpy'):
+            result = self.loop.run_until_complete(
+                estimate_async(dataset, seedset, 3, multiprocess=3, engine=engine, r=5000, cache=False))
+            self.assertEqual(estimate(dataset, seedset, 3, multiprocess=2, random_seed='88010123',
+                                      engine=engine, r=5000, cache=False), result)
+
+    def test_cancel(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        with open('./examples/seeds.txt', 'r') as seeds:
+            seedset = seeds.read()
+        progress = []
+        async def run_main():
+            task = asyncio.ensure_future(estimate_async(dataset, seedset, 3, model='LT', multiprocess=2, r=10 ** 7,
+                                                        cache=False, progress=lambda *args: progress.append(args)))
+            while not progress:
+                await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The pool is free once the running chunks end
+            started = time.time()
+            await asyncio.get_event_loop().run_in_executor(self.pool, time.sleep, 0)
+            self.assertLess(time.time() - started, 5)
+        self.loop.run_until_complete(run_main())
+        self.assertEqual(10 ** 7, progress[0][1])
+        self.assertLess(progress[-1][0], 10 ** 6)
+
+    def test_cancel_parsing(self):
+        with open('./examples/network.txt', 'r') as network:
+            dataset = network.read()
+        class SlowCache(NetworkCache):
+            def get(self, network):
+                time.sleep(0.3)
+                return super(SlowCache, self).get(network)
+        cache = ie.network_cache
+        ie.network_cache = SlowCache(cache.max_bytes)
+        try:
+            async def run_main():
+                task = asyncio.ensure_future(estimate_async(dataset, '56\n58\n38', 3, cache=False))
+                await asyncio.sleep(0.1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                # Given back once parsed
+                await asyncio.sleep(0.5)
+            self.loop.run_until_complete(run_main())
+            self.assertEqual([0], list(ie.network_cache._users.values()))
+        finally:
+            ie.network_cache.clear()
+            ie.network_cache = cache
+
+    def tearDown(self):
+        shutdown_pool()
+        self.loop.close()
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate(self):
+        for kind in ('er', 'powerlaw'):
+            network = ie_bench.generate_network(kind, 200, 1000, 'wc', seed=1)
+            self.assertEqual(network, ie_bench.generate_network(kind, 200, 1000, 'wc', seed=1))
+            graph = parse_network(network)
+            self.assertLessEqual(graph.vnum, 200)
+            # Weighted cascade weights into a vertex sum up to 1
+            self.assertAlmostEqual(1., graph.in_weight[graph.in_offset[0]:graph.in_offset[1]].sum(), places=4)
+
+    def test_compare(self):
+        baseline = {'a.parse_sec': 1., 'a.IC.numpy.samples_per_sec': 100.}
+        self.assertEqual([], ie_bench.compare({'a.parse_sec': 1.05, 'a.IC.numpy.samples_per_sec': 95.}, baseline, 0.1))
+        regressions = ie_bench.compare({'a.parse_sec': 1.5, 'a.IC.numpy.samples_per_sec': 50.}, baseline, 0.1)
+        self.assertEqual(['a.IC.numpy.samples_per_sec', 'a.parse_sec'], [r[0] for r in regressions])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,5 +6,58 @@ websocket_url = 'ws://localhost:8765/api/websocket'
 username = 'user'
 password = 'password'
 log_level = logging.DEBUG
-parallel_judge_tasks = 2
+# Cases taken at once, each run when the CPUs and memory it declares are free
+parallel_judge_tasks = 8
+# CPUs and memory (MB) for containers, None for those of the host less the scoring reserve
+judge_cpus = None
+judge_memory = None
+# Memory (MB) kept for IMP scoring, besides scoring_processes CPUs
+scoring_memory = 2048
+# Seconds a case waits before smaller cases stop being run ahead of it
+admission_max_wait = 60
+# Threads decoding and extracting cases, and cases prepared ahead of the judge tasks
+prepare_tasks = 2
+prepare_ahead = 2
+# IMP cases scored at once, after their container has finished
+scoring_tasks = 2
+# Bytes kept of each of stdout and stderr, a quarter from the head and the rest from the tail
 log_limit_bytes = 256 * 1024
+# Containers created ahead of time for cases of a (cpu, memory) shape, e.g. {(1, 256): 2}
+container_pool = {}
+# Bytes of data/ files kept for the next submissions of the same task
+data_cache_bytes = 1024 * 1024 * 1024
+# Kill a container once its output exceeds this many bytes, or this many bytes per second, None for no limit
+log_flood_bytes = None
+log_flood_rate = None
+# Processes (cores) shared by IMP scoring of all judge tasks
+scoring_processes = 4
+# Pin every container to its own CPUs, as many as its cpu, and scoring to scoring_processes others
+cpu_pinning = True
+# Memory budget of parsed IMP networks kept between cases
+network_cache_bytes = 256 * 1024 * 1024
+# IMP scoring engine: 'python', 'numpy' or 'index' (pre-sampled live-edge graphs, same samples for everyone)
+scoring_engine = 'python'
+# Where live-edge indexes of the 'index' engine are kept
+index_dir = '/tmp/carp_judge_index'
+# Bytes of indexes kept in index_dir, least recently used are removed first, None for no limit
+index_max_bytes = 4 * 1024 * 1024 * 1024
+# Extra ie.estimate_async() options for IMP scoring, e.g. adaptive sampling with
+# {'rel_tolerance': 0.005, 'r_min': 1000, 'r_max': 100000}, or with the 'index' engine
+# {'breakdown': True} to add the marginal influence of every seed to CASE_RESULT
+scoring_options = {}
+# Seconds between CASE_PROGRESS messages of an IMP scoring, e.g. 1.0 if the server knows them, None to send none
+progress_interval = None
+# SQLite file keeping IMP scores across restarts, None to keep them in memory only
+score_cache_path = '/tmp/carp_judge_scores.db'
+# Scores kept in score_cache_path, least recently used are dropped first
+score_cache_entries = 100000
+# Serve Prometheus metrics (phase latencies, queue depths) at http://metrics_host:metrics_port/metrics, None to disable
+metrics_host = '127.0.0.1'
+metrics_port = None
+# Add the seconds spent in each phase of a case to CASE_RESULT as timings
+report_timings = True
+# Offer the server msgpack messages in binary frames, with case archives and logs not base64 or JSON encoded,
+# falling back to JSON if it does not choose them
+binary_protocol = True
+# Compression of websocket messages, 'deflate' (permessage-deflate) or None
+websocket_compression = 'deflate'
@@ -0,0 +1,116 @@
+import os
+import glob
+
+SYSFS_DIR = '/sys/devices/system'
+
+
+def parse_cpulist(text):
+    '''
+    Returns the CPUs of a kernel CPU list such as 0-3,8,10-11.
+    '''
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    return ','.join(str(cpu) for cpu in sorted(cpus))
+
+
+def _read(path, default=None):
+    try:
+        with open(path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return default
+
+
+def read_topology(sysfs=SYSFS_DIR, cpus=None):
+    '''
+    Returns {cpu: (NUMA node, package, core)} of the online CPUs among cpus,
+    by default those this process may use, from sysfs. Without topology
+    information, every CPU is its own core on node 0.
+    '''
+    if cpus is None:
+        cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+    cpus = set(cpus)
+    online = _read(os.path.join(sysfs, 'cpu', 'online'))
+    if online is not None:
+        cpus &= set(parse_cpulist(online))
+    nodes = {}
+    for path in glob.glob(os.path.join(sysfs, 'node', 'node[0-9]*', 'cpulist')):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        for cpu in parse_cpulist(_read(path, '')):
+            nodes[cpu] = node
+    topology = {}
+    for cpu in cpus:
+        directory = os.path.join(sysfs, 'cpu', 'cpu{}'.format(cpu), 'topology')
+        package = int(_read(os.path.join(directory, 'physical_package_id'), 0))
+        core = int(_read(os.path.join(directory, 'core_id'), cpu))
+        topology[cpu] = (nodes.get(cpu, 0), package, core)
+    return topology
+
+
+class CpuAllocator:
+    '''
+    Hands out exclusive sets of CPUs. A set is taken from a single NUMA
+    node when one has enough free CPUs, the fullest such node first so that
+    large sets stay possible, and from whole physical cores where it can so
+    that hyperthread siblings are rarely shared between sets.
+
+    Without a topology, see discover(), nothing is ever allocated.
+    '''
+    def __init__(self, topology=None):
+        self.topology = topology or {}
+        self.free = set(self.topology)
+
+    def discover(self, sysfs=SYSFS_DIR):
+        '''
+        Reads the topology of the host, all CPUs being free.
+        '''
+        self.topology = read_topology(sysfs)
+        self.free = set(self.topology)
+
+    def allocate(self, count):
+        '''
+        Returns a set of count CPUs, or None if fewer are free.
+        '''
+        if count > len(self.free):
+            return None
+        nodes = {}
+        for cpu in self.free:
+            nodes.setdefault(self.topology[cpu][0], []).append(cpu)
+        fitting = [cpus for cpus in nodes.values() if len(cpus) >= count]
+        if fitting:
+            candidates = min(fitting, key=len)
+        else:
+            # Span nodes, the emptiest first
+            candidates = [cpu for cpus in sorted(nodes.values(), key=len, reverse=True) for cpu in cpus]
+        cores = {}
+        for cpu in candidates:
+            cores.setdefault(self.topology[cpu][1:], []).append(cpu)
+        cores = [sorted(cpus) for cpus in cores.values()]
+        allocated = set()
+        while len(allocated) < count:
+            remaining = count - len(allocated)
+            whole = [cpus for cpus in cores if len(cpus) <= remaining]
+            if whole:
+                # The largest core taken whole
+                cpus = max(whole, key=len)
+            else:
+                # Part of the smallest core
+                cpus = min(cores, key=len)[:remaining]
+            cores = [rest for rest in ([cpu for cpu in core if cpu not in cpus] for core in cores) if rest]
+            allocated.update(cpus)
+        self.free -= allocated
+        return allocated
+
+    def release(self, cpus):
+        self.free |= set(cpus) & set(self.topology)
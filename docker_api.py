@@ -0,0 +1,207 @@
+import json
+import time
+import asyncio
+import struct
+import calendar
+import aiohttp
+
+from errors import SandboxError
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+# Engine API version, the oldest with everything used here
+API_VERSION = 'v1.25'
+
+# Stream types in the header of multiplexed log frames
+STDOUT = 1
+STDERR = 2
+
+
+def demux(data):
+    '''
+    Splits the multiplexed logs of a container without a TTY into stdout
+    and stderr. Each frame is an 8 bytes header, the stream type and the
+    big-endian payload size, followed by the payload.
+    '''
+    streams = {STDOUT: bytearray(), STDERR: bytearray()}
+    pos = 0
+    while pos + 8 <= len(data):
+        stream, size = struct.unpack_from('>BxxxL', data, pos)
+        pos += 8
+        if stream in streams:
+            streams[stream] += data[pos:pos + size]
+        pos += size
+    return bytes(streams[STDOUT]), bytes(streams[STDERR])
+
+
+def parse_time(text):
+    '''
+    Returns the seconds since the epoch of an Engine API timestamp such as
+    2018-10-01T08:00:00.123456789Z, or None for the zero time of a
+    container that has not started or exited yet.
+    '''
+    if not text or text.startswith('0001-'):
+        return None
+    seconds = calendar.timegm(time.strptime(text[:19], '%Y-%m-%dT%H:%M:%S'))
+    fraction = ''
+    if text[19:20] == '.':
+        for char in text[20:]:
+            if not char.isdigit():
+                break
+            fraction += char
+    return seconds + float('0.' + (fraction or '0'))
+
+
+class DockerClient:
+    '''
+    Docker Engine API client over one pooled unix socket session, so that
+    no container operation blocks the event loop.
+
+    The session is opened on first use in the running event loop, and
+    opened again if it is later used from another loop. Requests taking as
+    long as the container runs have no time limit unless given one, all
+    others time out after timeout seconds.
+    '''
+    def __init__(self, socket_path=DOCKER_SOCKET, limit=0, timeout=60):
+        self.socket_path = socket_path
+        self.limit = limit
+        self.timeout = timeout
+        self._session = None
+        self._loop = None
+
+    def _get_session(self):
+        loop = asyncio.get_event_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.UnixConnector(path=self.socket_path, limit=self.limit)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+            self._loop = loop
+        return self._session
+
+    def _open(self, method, path, params=None, json=None, timeout=None):
+        url = 'http://localhost/{}{}'.format(API_VERSION, path)
+        return self._get_session().request(method, url, params=params, json=json,
+                                           timeout=aiohttp.ClientTimeout(total=timeout))
+
+    @staticmethod
+    async def _check(resp, method, path):
+        if resp.status >= 400:
+            body = await resp.read()
+            raise SandboxError('Docker API {} {}: {} {}'.format(
+                method, path, resp.status, body.decode('utf8', 'replace').strip()))
+
+    async def _send(self, method, path, params=None, json=None, timeout=None):
+        '''
+        Same as _request(), but raises asyncio.TimeoutError after timeout
+        seconds.
+        '''
+        try:
+            async with self._open(method, path, params, json, timeout) as resp:
+                await self._check(resp, method, path)
+                body = await resp.read()
+                if resp.content_type == 'application/json' and body:
+                    return await resp.json()
+                return body
+        except aiohttp.ClientError as e:
+            if isinstance(e, asyncio.TimeoutError):
+                raise
+            raise SandboxError('Docker API {} {}: {}'.format(method, path, e))
+
+    async def _request(self, method, path, params=None, json=None, timeout=None):
+        try:
+            return await self._send(method, path, params, json, timeout)
+        except asyncio.TimeoutError:
+            raise SandboxError('Docker API {} {}: timed out after {} seconds'.format(method, path, timeout))
+
+    async def create(self, config, name=None):
+        '''
+        Creates a container from an Engine API container config and returns
+        its id.
+        '''
+        params = {'name': name} if name else None
+        response = await self._request('POST', '/containers/create', params=params, json=config, timeout=self.timeout)
+        return response['Id']
+
+    async def start(self, container_id):
+        await self._request('POST', '/containers/{}/start'.format(container_id), timeout=self.timeout)
+
+    async def update(self, container_id, resources):
+        '''
+        Changes resource limits of a container, such as CpusetCpus.
+        '''
+        await self._request('POST', '/containers/{}/update'.format(container_id), json=resources,
+                            timeout=self.timeout)
+
+    async def wait(self, container_id, timeout=None):
+        '''
+        Waits for a container to exit and returns its status, a dict with
+        StatusCode. Raises asyncio.TimeoutError after timeout seconds.
+        '''
+        return await self._send('POST', '/containers/{}/wait'.format(container_id), timeout=timeout)
+
+    async def logs(self, container_id, stdout=True, stderr=True):
+        '''
+        Returns (stdout, stderr) of a container as bytes.
+        '''
+        params = {'stdout': '1' if stdout else '0', 'stderr': '1' if stderr else '0'}
+        return demux(await self._request('GET', '/containers/{}/logs'.format(container_id), params=params,
+                                         timeout=self.timeout))
+
+    async def follow_logs(self, container_id, stdout=True, stderr=True, chunk_size=65536):
+        '''
+        Yields (stream, data) pieces of the logs of a container, from its
+        start until it exits, reading no more than chunk_size bytes at once.
+        '''
+        path = '/containers/{}/logs'.format(container_id)
+        params = {'stdout': '1' if stdout else '0', 'stderr': '1' if stderr else '0', 'follow': '1'}
+        try:
+            async with self._open('GET', path, params) as resp:
+                await self._check(resp, 'GET', path)
+                while True:
+                    try:
+                        header = await resp.content.readexactly(8)
+                    except asyncio.IncompleteReadError:
+                        return
+                    stream, size = struct.unpack('>BxxxL', header)
+                    while size:
+                        data = await resp.content.read(min(size, chunk_size))
+                        if not data:
+                            return
+                        size -= len(data)
+                        yield stream, data
+        except aiohttp.ClientError as e:
+            raise SandboxError('Docker API GET {}: {}'.format(path, e))
+
+    async def inspect(self, container_id):
+        '''
+        Returns the low-level information of a container, such as its State.
+        '''
+        return await self._request('GET', '/containers/{}/json'.format(container_id), timeout=self.timeout)
+
+    async def stats(self, container_id):
+        '''
+        Yields the resource usage of a running container about every second,
+        until it stops.
+        '''
+        path = '/containers/{}/stats'.format(container_id)
+        try:
+            async with self._open('GET', path, {'stream': '1'}) as resp:
+                await self._check(resp, 'GET', path)
+                while True:
+                    line = await resp.content.readline()
+                    if not line:
+                        return
+                    if line.strip():
+                        yield json.loads(line)
+        except aiohttp.ClientError as e:
+            raise SandboxError('Docker API GET {}: {}'.format(path, e))
+
+    async def kill(self, container_id):
+        await self._request('POST', '/containers/{}/kill'.format(container_id), timeout=self.timeout)
+
+    async def remove(self, container_id, force=True):
+        params = {'force': '1' if force else '0'}
+        await self._request('DELETE', '/containers/{}'.format(container_id), params=params, timeout=self.timeout)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -6,14 +6,46 @@ import sys
 import io
 import multiprocessing as mp
 import math
+import mmap
+import os
+import tempfile
+import hashlib
+import fcntl
+import json
+import sqlite3
+import atexit
+import threading
+import warnings
 import numpy
 from itertools import chain
+from collections import OrderedDict
+from statistics import NormalDist
 
 from concurrent.futures import ProcessPoolExecutor
 import asyncio
 
+ENGINES = ('python', 'numpy', 'index')
+
+# Where Graph.share() puts its files, memory backed when possible
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Samples are drawn in blocks of this many, each block with its own random
+# stream derived from the job's random seed and the block's index. Work is
+# split on block boundaries, so sample i is the same whichever process draws it.
+SAMPLE_BLOCK = 256
+
+# Samples in a chunk of work handed to whichever sampler process is idle.
+# Small enough that the last chunks finish close together, large enough that
+# queueing a task and its result costs little next to drawing the samples.
+CHUNK_SAMPLES = 4 * SAMPLE_BLOCK
+
+# Vertex states in Sampler.status
+INACTIVE = 0
+ACTIVE = 1
+REACHED = 2
+
 class Sampler(mp.Process):
-    def __init__(self, graph, type, inQ, outQ, random_seed):
+    def __init__(self, graph, type, inQ, outQ, random_seed, engine='python', index=None):
         super(Sampler, self).__init__(target=self.start)
         self.graph = graph
         self.type = type
@@ -22,175 +54,1072 @@ class Sampler(mp.Process):
         self.types = {'IC': self.one_IC_sample, 'LT': self.one_LT_sample}
         self.func = self.types[self.type]
         self.random_seed = random_seed
+        self.engine = engine
+        self.index = index
         
     def run(self):
-        random.seed(self.random_seed)
+        self.prepare()
         while True:
             task = self.inQ.get()
             if task is None:
                 break
-            sample = self.single_sample(task[0], task[1])
-            self.outQ.put(sample)
+            self.outQ.put(self.moments(*task))
+
+    def prepare(self):
+        '''
+        Sets up the state sampling needs in the current process. Called by
+        run(), and directly by scoring pool workers which use a Sampler
+        without starting it as a process.
+        '''
+        self.entropy = seed_entropy(self.random_seed)
+        if self.engine == 'numpy':
+            self.batch = BatchSampler(self.graph, self.type, self.entropy)
+            return
+        if self.engine == 'index':
+            self.batch = IndexSampler(self.graph, self.index)
+            return
+        # memoryviews give plain Python scalars on indexing, which is much
+        # faster than indexing the numpy arrays element by element
+        self.offset = memoryview(self.graph.offset)
+        self.target = memoryview(self.graph.target)
+        self.weight = memoryview(self.graph.weight)
+        # Per-sample buffers, every sample resets the vertices it touched
+        self.status = bytearray(self.graph.vnum)
+        if self.type == 'LT':
+            self.impact = memoryview(numpy.zeros(self.graph.vnum))
+            self.gate = memoryview(numpy.zeros(self.graph.vnum))
         
-    def single_sample (self,seeds, r):
+    def single_sample (self,seeds, r, start=0):
+        '''
+        Draws samples start to start + r - 1.
+        '''
+        if self.engine != 'python':
+            return self.batch.sample(seeds, r, start).tolist()
         sample = []
-        activate(seeds, self.graph.status)
-        for i in range(r):
-            sample.append(self.func(seeds))
-        inactivate(seeds, self.graph.status)
+        for block, skip, count in sample_blocks(start, r):
+            self.random = random.Random(python_seed(self.entropy, block))
+            for i in range(skip):
+                self.func(seeds)
+            for i in range(count):
+                sample.append(self.func(seeds))
         return sample
+
+    def moments (self, seeds, r, start=0, breakdown=False):
+        '''
+        Draws samples start to start + r - 1 and returns their moments(),
+        which are much cheaper to send between processes than the samples.
+        With breakdown, the sums of IndexSampler.breakdown() follow.
+        '''
+        if breakdown:
+            if self.engine != 'index':
+                raise ValueError('Seed breakdown needs the index engine')
+            sample, reach, unique = self.batch.breakdown(seeds, r, start)
+            return moments(sample) + (reach.tolist(), unique.tolist())
+        if self.engine != 'python':
+            return moments(self.batch.sample(seeds, r, start))
+        return moments(self.single_sample(seeds, r, start))
         
     def one_IC_sample (self, seeds):
-        neighbours = self.graph.neighbour
-        status = list(self.graph.status)
+        offset = self.offset
+        target = self.target
+        weight = self.weight
+        rand = self.random.random
+        status = self.status
+        activate(seeds, status)
+        touched = list(seeds)
         active_set = seeds
         influence_area = len(seeds)
         while active_set:
             new_active_set = []
             for vertex in active_set:
-                for neighbour, weight in neighbours[vertex]:
-                    if not status[neighbour] and random.random() <= weight:
-                        status[neighbour] = True
+                for edge in range(offset[vertex], offset[vertex + 1]):
+                    neighbour = target[edge]
+                    if not status[neighbour] and rand() <= weight[edge]:
+                        status[neighbour] = ACTIVE
                         new_active_set.append(neighbour)
             influence_area += len(new_active_set)
+            touched += new_active_set
             active_set = new_active_set
+        inactivate(touched, status)
         return influence_area
 
     def one_LT_sample (self, seeds):
-        neighbours = self.graph.neighbour
-        last_neighbours = self.graph.last_neighbour
-        status = list(self.graph.status)
+        '''
+        Keeps the weight of active in-neighbours of every reached vertex and
+        only adds to it along out-edges of newly activated vertices, so each
+        edge is looked at once per sample. A threshold is drawn the first
+        time a vertex is reached instead of for every vertex up front.
+        '''
+        offset = self.offset
+        target = self.target
+        weight = self.weight
+        status = self.status
+        impact = self.impact
+        gate = self.gate
+        rand = self.random.random
+        activate(seeds, status)
+        touched = list(seeds)
         active_set = seeds
         influence_area = len(seeds)
-        gate = [random.random() for i in range(self.graph.vnum)]
         while active_set:
             new_active_set = []
             for vertex in active_set:
-                for neighbour, p in neighbours[vertex]:
-                    if not status[neighbour]:
-                        impact = 0
-                        for last_neighbour, weight in last_neighbours[neighbour]:
-                            if status[last_neighbour]:
-                                impact += weight
-                        if impact >= gate[neighbour]:
-                            status[neighbour] = True
-                            new_active_set.append(neighbour)
+                for edge in range(offset[vertex], offset[vertex + 1]):
+                    neighbour = target[edge]
+                    state = status[neighbour]
+                    if state == ACTIVE:
+                        continue
+                    if state == INACTIVE:
+                        status[neighbour] = REACHED
+                        gate[neighbour] = rand()
+                        impact[neighbour] = weight[edge]
+                        touched.append(neighbour)
+                    else:
+                        impact[neighbour] += weight[edge]
+                    if impact[neighbour] >= gate[neighbour]:
+                        status[neighbour] = ACTIVE
+                        new_active_set.append(neighbour)
             influence_area += len(new_active_set)
             active_set = new_active_set
+        inactivate(touched, status)
         return influence_area
     
+class BatchSampler(object):
+    '''
+    Runs many independent cascades at once over numpy arrays.
+
+    A batch of b cascades keeps its status as one flat b * vnum boolean array,
+    cascade i owning the slice [i * vnum, (i + 1) * vnum). The frontier of
+    all cascades is a single array of flat indices, so each round expands
+    every out-edge of every frontier vertex in one vectorized step: IC flips
+    all their coins at once, LT adds their weights to the reached vertices.
+    '''
+    # Upper bound of the per-batch buffers in bytes, decides the batch size
+    buffer_size = 1 << 24
+
+    def __init__(self, graph, type, entropy):
+        self.graph = graph
+        self.type = type
+        self.entropy = entropy
+        self.rng = None
+        self.types = {'IC': self.IC_batch, 'LT': self.LT_batch}
+        self.func = self.types[self.type]
+        # status, plus impact and gate for LT
+        slot_size = 1 if type == 'IC' else 17
+        self.batch = max(1, self.buffer_size // slot_size // max(1, graph.vnum))
+        self.status = None
+
+    def sample(self, seeds, r, start=0):
+        result = numpy.empty(r, dtype=numpy.int64)
+        done = 0
+        for block, skip, count in sample_blocks(start, r):
+            self.rng = numpy_generator(self.entropy, block)
+            # A block is always split into the same batches, so a sample
+            # does not depend on which other samples of its block are drawn
+            drawn = 0
+            while drawn < skip + count:
+                b = min(self.batch, SAMPLE_BLOCK - drawn)
+                sample = self.func(seeds, b)[max(skip - drawn, 0):skip + count - drawn]
+                result[done:done + len(sample)] = sample
+                done += len(sample)
+                drawn += b
+        return result
+
+    def _start(self, seeds, b):
+        n = self.graph.vnum
+        if self.status is None or len(self.status) < b * n:
+            self.status = numpy.zeros(b * n, dtype=bool)
+        status = self.status[:b * n]
+        status.fill(False)
+        unique_seeds = numpy.unique(numpy.asarray(seeds, dtype=numpy.int64))
+        frontier = (numpy.arange(b, dtype=numpy.int64)[:, None] * n + unique_seeds).ravel()
+        status[frontier] = True
+        return status, frontier, len(seeds) - len(unique_seeds)
+
+    def _expand(self, frontier):
+        '''
+        Returns the flat index of the target and the edge index of every
+        out-edge of the frontier vertices.
+        '''
+        graph = self.graph
+        vertex = frontier % graph.vnum
+        start = graph.offset[vertex]
+        degree = graph.offset[vertex + 1] - start
+        total = int(degree.sum())
+        first = numpy.cumsum(degree) - degree
+        edges = numpy.arange(total, dtype=numpy.int64) + numpy.repeat(start - first, degree)
+        return numpy.repeat(frontier - vertex, degree) + graph.target[edges], edges
+
+    def _count(self, status, b, duplicates):
+        # Duplicated seeds are counted once per occurrence, as in Sampler
+        return numpy.count_nonzero(status.reshape(b, self.graph.vnum), axis=1) + duplicates
+
+    def IC_batch(self, seeds, b):
+        status, frontier, duplicates = self._start(seeds, b)
+        self._spread(status, frontier)
+        return self._count(status, b, duplicates)
+
+    def _spread(self, status, frontier):
+        while len(frontier):
+            reached, edges = self._expand(frontier)
+            reached = reached[self._live(reached // self.graph.vnum, edges)]
+            reached = numpy.unique(reached[~status[reached]])
+            status[reached] = True
+            frontier = reached
+
+    def _live(self, cascades, edges):
+        '''
+        Decides which of the given edges are live in the given cascades of
+        the current batch.
+        '''
+        return self.rng.random(len(edges)) <= self.graph.weight[edges]
+
+    def LT_batch(self, seeds, b):
+        status, frontier, duplicates = self._start(seeds, b)
+        impact = numpy.zeros(len(status), dtype=numpy.float64)
+        gate = self.rng.random(len(status))
+        while len(frontier):
+            reached, edges = self._expand(frontier)
+            inactive = ~status[reached]
+            reached, edges = reached[inactive], edges[inactive]
+            reached, index = numpy.unique(reached, return_inverse=True)
+            impact[reached] += numpy.bincount(index, weights=self.graph.weight[edges], minlength=len(reached))
+            reached = reached[impact[reached] >= gate[reached]]
+            status[reached] = True
+            frontier = reached
+        return self._count(status, b, duplicates)
+
+class IndexSampler(BatchSampler):
+    '''
+    BatchSampler reading the live edges of its cascades from a LiveEdgeIndex
+    instead of drawing them, cascade i of sample(seeds, r, start) being
+    sample start + i of the index.
+    '''
+    def __init__(self, graph, index):
+        super(IndexSampler, self).__init__(graph, 'IC', None)
+        self.index = index
+        # status, plus hits and owner for breakdown()
+        self.breakdown_batch = max(1, self.buffer_size // 9 // max(1, graph.vnum))
+
+    def sample(self, seeds, r, start=0):
+        if start + r > self.index.samples:
+            raise ValueError('Index has only {} samples'.format(self.index.samples))
+        result = numpy.empty(r, dtype=numpy.int64)
+        done = 0
+        while done < r:
+            b = min(self.batch, r - done)
+            self.first = start + done
+            result[done:done + b] = self.func(seeds, b)
+            done += b
+        return result
+
+    def breakdown(self, seeds, r, start=0):
+        '''
+        Same samples as sample(), drawn by spreading from every distinct seed
+        on its own over the same live edges. Also returns, for each seed of
+        numpy.unique(seeds), the sums over the samples of the vertices it
+        reaches, and of those no other seed reaches.
+        '''
+        if start + r > self.index.samples:
+            raise ValueError('Index has only {} samples'.format(self.index.samples))
+        n = self.graph.vnum
+        unique_seeds = numpy.unique(numpy.asarray(seeds, dtype=numpy.int64))
+        result = numpy.empty(r, dtype=numpy.int64)
+        reach = numpy.zeros(len(unique_seeds), dtype=numpy.int64)
+        unique = numpy.zeros(len(unique_seeds), dtype=numpy.int64)
+        done = 0
+        while done < r:
+            b = min(self.breakdown_batch, r - done)
+            self.first = start + done
+            # Seeds reaching each vertex, and the last of them
+            hits = numpy.zeros(b * n, dtype=numpy.int32)
+            owner = numpy.zeros(b * n, dtype=numpy.int32)
+            for i, seed in enumerate(unique_seeds):
+                status, frontier, duplicates = self._start([seed], b)
+                self._spread(status, frontier)
+                hits += status
+                owner[status] = i
+                reach[i] += numpy.count_nonzero(status)
+            unique += numpy.bincount(owner[hits == 1], minlength=len(unique_seeds))
+            # Duplicated seeds are counted once per occurrence, as in Sampler
+            result[done:done + b] = (numpy.count_nonzero((hits > 0).reshape(b, n), axis=1)
+                                     + len(seeds) - len(unique_seeds))
+            done += b
+        return result, reach, unique
+
+    def _live(self, cascades, edges):
+        bits = self.index.bits[cascades + self.first, edges >> 3]
+        return (bits >> (7 - (edges & 7)).astype(numpy.uint8)) & 1 == 1
+
+class LiveEdgeIndex(object):
+    '''
+    Pre-sampled live-edge graphs of a network, one bit per edge and sample.
+    Under IC an edge is live with its probability. Under LT every vertex
+    keeps at most one in-edge, each picked with its weight, which gives the
+    same distribution of activated sets as random thresholds. The influence
+    of a seed set is then the mean number of vertices reachable from it.
+
+    Saved indexes are memory mapped read-only, and a pickled saved index
+    only carries its path.
+    '''
+    # Upper bound of the buffers of a build step in bytes, decides how many
+    # samples it generates
+    buffer_size = 1 << 24
+    # Bumped whenever the edge order of Graph changes, as bits follow it
+    version = 2
+
+    def __init__(self, type, bits, path=None):
+        self.type = type
+        self.bits = bits
+        self.samples = len(bits)
+        self.path = path
+
+    @classmethod
+    def build(cls, graph, type, samples, rng, bits=None):
+        if bits is None:
+            bits = numpy.zeros((samples, (graph.enum + 7) // 8), dtype=numpy.uint8)
+        if type == 'LT':
+            # Forward index of every in-edge, as ordered by Graph
+            in_edge = numpy.argsort(graph.target, kind='stable')
+            total = numpy.cumsum(graph.in_weight)
+            before = numpy.concatenate(([0.], total))[graph.in_offset[:-1]]
+            end = graph.in_offset[1:]
+            # live, then a random number, a picked edge and a bound per vertex
+            slot_size = graph.enum + 24 * graph.vnum
+        else:
+            # A random number per edge, and live
+            slot_size = 9 * graph.enum
+        # Random numbers are drawn in sample order, so the step size does not
+        # change the samples
+        batch = max(1, cls.buffer_size // max(1, slot_size))
+        for first in range(0, samples, batch):
+            b = min(batch, samples - first)
+            if type == 'IC':
+                live = rng.random((b, graph.enum)) <= graph.weight
+            elif type == 'LT':
+                live = numpy.zeros((b, graph.enum), dtype=bool)
+                picked = numpy.searchsorted(total, before + rng.random((b, graph.vnum)), side='right')
+                rows, vertices = numpy.nonzero(picked < end)
+                live[rows, in_edge[picked[rows, vertices]]] = True
+            else:
+                raise ValueError('Unknown model: ' + type)
+            bits[first:first + b] = numpy.packbits(live, axis=1)
+        return cls(type, bits)
+
+    @classmethod
+    def load(cls, path, type):
+        return cls(type, numpy.load(path, mmap_mode='r'), path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            del state['bits']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.bits = numpy.load(self.path, mmap_mode='r')
+
+# Where load_index() keeps live-edge indexes
+INDEX_DIR = os.path.join(tempfile.gettempdir(), 'carp_judge_index')
+# Bytes of indexes kept under INDEX_DIR, least recently used are removed
+# first by evict_indexes(), None for no limit
+INDEX_MAX_BYTES = 4 * 1024 * 1024 * 1024
+# Prefix of indexes being built
+INDEX_BUILD_PREFIX = 'build-'
+
+# Jobs using each index path, whose index must not be removed
+_index_users = {}
+_index_lock = threading.Lock()
+
+def index_bytes(graph, samples):
+    return samples * ((graph.enum + 7) // 8)
+
+def index_fits(graph, samples):
+    '''
+    Whether an index of graph with samples samples fits in INDEX_MAX_BYTES.
+    '''
+    return INDEX_MAX_BYTES is None or index_bytes(graph, samples) <= INDEX_MAX_BYTES
+
+def load_index(graph, type, samples, random_seed):
+    '''
+    Returns the live-edge index of a cached graph, building and saving it
+    under INDEX_DIR first if it is not there yet. Processes loading the
+    same index while it is built wait for it instead of building it too.
+    '''
+    seed = hashlib.sha256(str(random_seed).encode('utf8')).hexdigest()[:16]
+    name = '{}-{}-{}-{}-v{}.npy'.format(graph.key, type, samples, seed, LiveEdgeIndex.version)
+    path = os.path.join(INDEX_DIR, name)
+    if os.path.exists(path):
+        # Recently used, see evict_indexes()
+        os.utime(path)
+        return LiveEdgeIndex.load(path, type)
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    lock_path = os.path.join(INDEX_DIR, INDEX_BUILD_PREFIX + name + '.lock')
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Built by another process meanwhile
+        if os.path.exists(path):
+            return LiveEdgeIndex.load(path, type)
+        fd, tmp_path = tempfile.mkstemp(prefix=INDEX_BUILD_PREFIX, suffix='.npy', dir=INDEX_DIR)
+        os.close(fd)
+        try:
+            bits = numpy.lib.format.open_memmap(tmp_path, mode='w+', dtype=numpy.uint8,
+                                                shape=(samples, (graph.enum + 7) // 8))
+            LiveEdgeIndex.build(graph, type, samples, numpy.random.default_rng(int(seed, 16)), bits)
+            bits.flush()
+            del bits
+            os.replace(tmp_path, path)
+            # Processes waiting on it find the index once they get the lock
+            os.unlink(lock_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return LiveEdgeIndex.load(path, type)
+
+def index_engine(graph, engine, samples, breakdown):
+    '''
+    Returns the engine and breakdown to score with: the 'numpy' engine
+    without breakdown instead of an index larger than INDEX_MAX_BYTES.
+    '''
+    if engine != 'index' or index_fits(graph, samples):
+        return engine, breakdown
+    warnings.warn('Index of {} samples would take {} bytes, more than INDEX_MAX_BYTES, scoring with the numpy '
+                  'engine{}'.format(samples, index_bytes(graph, samples), ' without breakdown' if breakdown else ''))
+    return 'numpy', False
+
+def use_index(index):
+    '''
+    Marks an index as used by a job until release_index(), so that
+    evict_indexes() keeps it.
+    '''
+    with _index_lock:
+        _index_users[index.path] = _index_users.get(index.path, 0) + 1
+
+def release_index(index):
+    with _index_lock:
+        _index_users[index.path] -= 1
+        if not _index_users[index.path]:
+            del _index_users[index.path]
+
+def evict_indexes(keep=None):
+    '''
+    Removes the least recently used indexes under INDEX_DIR, other than the
+    paths in keep, by default those in use, until they fit in
+    INDEX_MAX_BYTES.
+    '''
+    if INDEX_MAX_BYTES is None:
+        return
+    if keep is None:
+        with _index_lock:
+            keep = set(_index_users)
+    entries = []
+    total = 0
+    try:
+        scan = list(os.scandir(INDEX_DIR))
+    except FileNotFoundError:
+        return
+    for entry in scan:
+        if entry.name.startswith(INDEX_BUILD_PREFIX) or not entry.name.endswith('.npy'):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        total += stat.st_size
+        if entry.path not in keep:
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= INDEX_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def seed_entropy(random_seed):
+    '''
+    Entropy of the random streams of a job, from a seed of any type.
+    '''
+    return int.from_bytes(hashlib.sha256(str(random_seed).encode('utf8')).digest(), 'little')
+
+def numpy_generator(entropy, block):
+    return numpy.random.Generator(numpy.random.Philox(numpy.random.SeedSequence(entropy, spawn_key=(block,))))
+
+def moments(sample):
+    '''
+    Returns (count, sum, sum of squares) of samples as Python ints.
+    '''
+    sample = numpy.asarray(sample, dtype=numpy.int64)
+    return len(sample), int(sample.sum()), int(numpy.dot(sample, sample))
+
+def python_seed(entropy, block):
+    return int.from_bytes(numpy.random.SeedSequence(entropy, spawn_key=(block,)).generate_state(4).tobytes(), 'little')
+
+def sample_blocks(start, r):
+    '''
+    Yields (block, skip, count) for every block holding some of samples
+    start to start + r - 1: the first skip samples of the block are drawn
+    and dropped, then count samples are kept.
+    '''
+    end = start + r
+    while start < end:
+        block, skip = divmod(start, SAMPLE_BLOCK)
+        count = min(SAMPLE_BLOCK - skip, end - start)
+        yield block, skip, count
+        start += count
+
+def chunk_work(first, r, size=CHUNK_SAMPLES):
+    '''
+    Splits samples first to first + r - 1 into (start, count) chunks of
+    size samples, or fewer for the last one, starting on block boundaries
+    given first does.
+    '''
+    return [(first + start, min(size, r - start)) for start in range(0, r, size)]
+
+def round_to_blocks(r):
+    return int(math.ceil(float(r) / SAMPLE_BLOCK)) * SAMPLE_BLOCK
+
+class Estimation(object):
+    '''
+    Running mean and variance of influence samples. Samples are integers, so
+    the sums are kept exactly as Python ints.
+    '''
+    def __init__(self, confidence=0.95):
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+        # Per seed sums of a seed breakdown, see IndexSampler.breakdown()
+        self.reach = None
+        self.unique = None
+
+    def add(self, sample):
+        self.merge(*moments(sample))
+
+    def merge(self, count, total, total_sq, reach=None, unique=None):
+        '''
+        Adds the moments() of samples drawn elsewhere, and their per seed
+        sums if they come with a breakdown.
+        '''
+        self.count += count
+        self.total += total
+        self.total_sq += total_sq
+        if reach is not None:
+            if self.reach is None:
+                self.reach = [0] * len(reach)
+                self.unique = [0] * len(unique)
+            self.reach = [a + b for a, b in zip(self.reach, reach)]
+            self.unique = [a + b for a, b in zip(self.unique, unique)]
+
+    def breakdown(self, ids):
+        '''
+        Influence of each seed of ids on its own, its marginal influence,
+        which the others do not reach, and its overlap with them.
+        '''
+        return [{
+            'seed': seed,
+            'influence': reach / self.count,
+            'marginal': unique / self.count,
+            'overlap': (reach - unique) / self.count
+        } for seed, reach, unique in zip(ids, self.reach, self.unique)]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    @property
+    def halfwidth(self):
+        '''
+        Half-width of the normal confidence interval of the mean.
+        '''
+        if self.count < 2:
+            return math.inf
+        variance = (self.count * self.total_sq - self.total * self.total) / (self.count * (self.count - 1))
+        return self.z * math.sqrt(max(variance, 0) / self.count)
+
+    def remaining(self, tolerance, rel_tolerance, r_min, r_max):
+        '''
+        Number of samples to draw next for the interval to reach the larger
+        of tolerance and rel_tolerance * mean, within [r_min, r_max] samples
+        in total, or 0 to stop.
+        '''
+        # Rounds are whole blocks, but for the last one
+        if self.count < r_min:
+            return min(round_to_blocks(r_min - self.count), r_max - self.count)
+        target = max(tolerance or 0., (rel_tolerance or 0.) * abs(self.mean))
+        halfwidth = self.halfwidth
+        if halfwidth <= target or self.count >= r_max:
+            return 0
+        if target > 0 and halfwidth < math.inf:
+            # The half-width shrinks with the square root of the sample count
+            needed = int(math.ceil(1.1 * self.count * (halfwidth / target) ** 2))
+        else:
+            needed = r_max
+        return min(round_to_blocks(needed - self.count), r_max - self.count)
+
+    def report(self):
+        halfwidth = self.halfwidth
+        return {
+            'influence': self.mean,
+            'samples': self.count,
+            'interval': [self.mean - halfwidth, self.mean + halfwidth],
+            'confidence': self.confidence
+        }
+
+def is_adaptive(tolerance, rel_tolerance):
+    return tolerance is not None or rel_tolerance is not None
+
 class ISE(object):
-    def __init__(self, graph, type, mnum):
+    def __init__(self, graph, type, mnum, engine='python', index=None, random_seed=0, breakdown=False):
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine: ' + engine)
+        if breakdown and engine != 'index':
+            raise ValueError('Seed breakdown needs the index engine')
         self.graph = graph
         self.type = type
         self.mnum = mnum
+        self.engine = engine
+        self.index = index
+        self.random_seed = random_seed
+        self.breakdown = breakdown
         self.result = 0
+        self.estimation = None
         
     def start_simpler(self):
+        # All workers take tasks from and put results to the same queues
+        self.inQ = mp.Queue()
+        self.outQ = mp.Queue()
         self.workers = []
         for i in range(self.mnum):
-            worker = Sampler(self.graph, self.type, mp.Queue(), mp.Queue(), random.random())
+            worker = Sampler(self.graph, self.type, self.inQ, self.outQ, self.random_seed, self.engine, self.index)
             self.workers.append(worker)
             worker.start()
             
     def finish(self):
         for w in self.workers:
-            w.inQ.put(None)
+            self.inQ.put(None)
         for w in self.workers:
             w.join()
         return self.result
-        
-    def multi_sample (self, seeds, r):
-        result = []
-        average_work = int(math.ceil(float(r) / (self.mnum)))
+
+    def cancel(self):
+        '''
+        Stops the workers without waiting for the chunks still queued.
+        '''
+        self.inQ.cancel_join_thread()
         for w in self.workers:
-            w.inQ.put((seeds, average_work))
+            w.terminate()
         for w in self.workers:
-            result += w.outQ.get()
-        return result
+            w.join()
+        
+    def multi_sample (self, seeds, r, first=0, estimation=None, progress=None):
+        '''
+        Draws samples first to first + r - 1 in chunks taken by whichever
+        worker is idle, and adds their moments to estimation as they arrive.
+        Sums are exact, so the result does not depend on the order.
+        progress is called with the number of samples in estimation after
+        every chunk.
+        '''
+        if estimation is None:
+            estimation = Estimation()
+        work = chunk_work(first, r)
+        # Two chunks per worker queued at most, so a worker never waits for
+        # the next one and cancel() has little to throw away
+        pending = 0
+        while work or pending:
+            while work and pending < 2 * self.mnum:
+                start, count = work.pop(0)
+                self.inQ.put((seeds, count, start, self.breakdown))
+                pending += 1
+            estimation.merge(*self.outQ.get())
+            pending -= 1
+            if progress is not None:
+                progress(estimation.count)
+        return estimation
 
     def sample_mean (self, seeds, r):
-        return numpy.mean(self.multi_sample(seeds, r))
+        return self.multi_sample(seeds, r).mean
 
-    def Testing (self, seeds, r):
-        starttime = time.time()
-        icsum = self.sample_mean(seeds, r)
-        parttime = time.time()
-        self.result = icsum
+    def Testing (self, seeds, r, tolerance=None, rel_tolerance=None, r_max=None, confidence=0.95, progress=None):
+        '''
+        Draws r samples, or with a tolerance, rounds of samples from r up to
+        r_max until the confidence interval is narrow enough. progress is
+        called with the samples done and r_max after every chunk.
+        '''
+        self.estimation = Estimation(confidence)
+        if not is_adaptive(tolerance, rel_tolerance):
+            r_max = r
+        if progress is not None:
+            progress = lambda done, progress=progress: progress(done, r_max)
+        remaining = self.estimation.remaining(tolerance, rel_tolerance, r, r_max)
+        while remaining:
+            self.multi_sample(seeds, remaining, self.estimation.count, self.estimation, progress)
+            remaining = self.estimation.remaining(tolerance, rel_tolerance, r, r_max)
+        self.result = self.estimation.mean
         
 class Graph(object):
-    def __init__ (self, vnum, enum):
-        self.vnum = vnum
-        self.enum = enum
-        self.num = 0
-        self.map = {}
-        self.anti_map = {}
-        self.neighbour = [set() for i in range(vnum)]
-        self.last_neighbour = [set() for i in range(vnum)]
-        self.status = [False for i in range(vnum)]
-        self.nonactive = set()
-    
-    def add_edge (self, vi, vj, weight):
-        if vi in self.map:
-            vi = self.map[vi]
-        else:
-            self.map[vi] = self.num
-            self.anti_map[self.num] = vi
-            vi = self.num
-            self.num += 1
-        if vj in self.map:
-            vj = self.map[vj]
-        else:
-            self.map[vj] = self.num
-            self.anti_map[self.num] = vj
-            vj = self.num
-            self.num += 1
-            
-        self.neighbour[vi].add((vj, weight))
-        self.last_neighbour[vj].add((vi, weight))
-        self.nonactive.add(vi)
-        self.nonactive.add(vj)
+    '''
+    Compressed sparse row (CSR) adjacency of a network.
+
+    Vertices are compacted to 0..vnum-1 in increasing order of their ids,
+    `ids` maps them back to those ids. Out-edges of vertex v are
+    target[offset[v]:offset[v+1]] with probabilities weight[...], in-edges
+    are in_source[in_offset[v]:in_offset[v+1]] with probabilities
+    in_weight[...].
+
+    share() moves the arrays into a memory mapped file, after which a pickled
+    graph only carries the path of that file.
+    '''
+    arrays = ('ids', 'offset', 'target', 'weight', 'in_offset', 'in_source', 'in_weight', 'nonactive')
+
+    def __init__ (self, ids, source, target, weight):
+        self.key = None
+        self.path = None
+        self.layout = None
+        self.vnum = len(ids)
+        self.ids = ids
+        # Sort edges by source, then target
+        key = source.astype(numpy.int64) * max(self.vnum, 1) + target
+        order = numpy.argsort(key, kind='stable')
+        sorted_key = key[order]
+        if (sorted_key[1:] == sorted_key[:-1]).any():
+            # Parallel edges with the same weight used to collapse in a set
+            order = numpy.lexsort((weight, key))
+            keep = numpy.ones(len(order), dtype=bool)
+            keep[1:] = (key[order][1:] != key[order][:-1]) | (weight[order][1:] != weight[order][:-1])
+            order = order[keep]
+        source, target, weight = source[order], target[order], weight[order]
+        self.enum = len(source)
+        # Sorted by source already
+        self.offset = self._offsets(source)
+        self.target = numpy.ascontiguousarray(target, dtype=numpy.int32)
+        self.weight = numpy.ascontiguousarray(weight, dtype=numpy.float64)
+        order = numpy.argsort(target, kind='stable')
+        self.in_offset = self._offsets(target)
+        self.in_source = numpy.ascontiguousarray(source[order], dtype=numpy.int32)
+        self.in_weight = numpy.ascontiguousarray(weight[order], dtype=numpy.float64)
+        self.nonactive = numpy.arange(self.vnum, dtype=numpy.int32)
+
+    def _offsets (self, vertices):
+        offset = numpy.zeros(self.vnum + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(vertices, minlength=self.vnum), out=offset[1:])
+        return offset
+
+    def index (self, vertices):
+        '''
+        Returns the compact indices of the given ids and whether each id is
+        missing from the network.
+        '''
+        vertices = numpy.asarray(vertices, dtype=numpy.int64)
+        index = numpy.minimum(numpy.searchsorted(self.ids, vertices), max(self.vnum - 1, 0))
+        if not self.vnum:
+            return index, numpy.ones(len(vertices), dtype=bool)
+        return index, self.ids[index] != vertices
+
+    def out_degree (self):
+        return numpy.diff(self.offset)
     
     def pruning (self):
-        delete = set()
-        for vertex in self.nonactive:
-            if not self.neighbour[vertex]:
-                delete.add(vertex)
-        self.nonactive = self.nonactive.difference(delete)
+        self.nonactive = numpy.flatnonzero(self.out_degree()).astype(numpy.int32)
+
+    def share (self):
+        '''
+        Writes the arrays to a file under SHARED_DIR and maps it read-only in
+        place of them. Processes unpickling the graph map the same file, so
+        the arrays are neither serialized nor copied per sampler.
+        '''
+        if self.path is not None:
+            return
+        fd, path = tempfile.mkstemp(prefix='carp_graph_', dir=SHARED_DIR)
+        try:
+            layout = {}
+            size = 0
+            for name in self.arrays:
+                array = getattr(self, name)
+                # Keep every array aligned to a cache line
+                size = (size + 63) // 64 * 64
+                layout[name] = (size, array.dtype.str, len(array))
+                os.pwrite(fd, memoryview(array).cast('B'), size)
+                size += array.nbytes
+            os.ftruncate(fd, max(size, 1))
+        finally:
+            os.close(fd)
+        self.path = path
+        self.layout = layout
+        self._attach()
+
+    def _attach (self):
+        with open(self.path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # The arrays keep the mapping alive, it is unmapped with the last of them
+        for name, (offset, dtype, count) in self.layout.items():
+            setattr(self, name, numpy.frombuffer(buffer, dtype=dtype, count=count, offset=offset))
+
+    def nbytes (self):
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def close (self):
+        '''
+        Removes the shared file. Processes which have mapped it keep their mapping.
+        '''
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def __getstate__ (self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            for name in self.arrays:
+                del state[name]
+        return state
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self._attach()
 
 def read_network(fd):
-    line = fd.readline().split()
-    vnum = int(line[0])
-    enum = int(line[1])
-    graph = Graph(vnum, enum)
-    lines = fd.readlines()
-    for line in lines:
-        if line:
-            e = line.split()
-            graph.add_edge(int(e[0]), int(e[1]), float(e[2]))
+    return parse_network(fd.read())
+
+def parse_network(network):
+    '''
+    Parses the text of a network, str or bytes: a "vnum enum" line followed by
+    "vi vj weight" lines. Numbers are parsed in bulk by numpy, and vertex ids
+    are compacted with unique() instead of a dict.
+    '''
+    newline = b'\n' if isinstance(network, bytes) else '\n'
+    lines = network.count(newline) + (0 if network.endswith(newline) else 1)
+    with warnings.catch_warnings():
+        # Raised by fromstring() for text it cannot parse to the end
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = numpy.fromstring(network, sep=' ')
+        except (ValueError, DeprecationWarning):
+            values = None
+    if values is None or len(values) != 2 + 3 * (lines - 1):
+        # Blank lines or extra columns
+        values = _parse_network_lines(network)
+    edges = values[2:].reshape(-1, 3)
+    vertices = edges[:, :2].ravel()
+    if not numpy.array_equal(vertices, numpy.floor(vertices)):
+        raise ValueError('Vertex ids of the network are not integers')
+    ids, compact = numpy.unique(vertices.astype(numpy.int64), return_inverse=True)
+    compact = compact.reshape(-1, 2).astype(numpy.int32)
+    graph = Graph(ids, compact[:, 0], compact[:, 1], numpy.ascontiguousarray(edges[:, 2]))
     graph.pruning()
     return graph
 
+def _parse_network_lines(network):
+    if isinstance(network, bytes):
+        network = network.decode('utf8')
+    lines = network.splitlines()
+    values = [int(value) for value in lines[0].split()[:2]]
+    for line in lines[1:]:
+        e = line.split()
+        if e:
+            values += (int(e[0]), int(e[1]), float(e[2]))
+    return numpy.array(values, dtype=numpy.float64)
+
+class NetworkCache(object):
+    '''
+    LRU cache of parsed and shared graphs keyed by the SHA-256 of the network
+    text, holding at most max_bytes of graphs. get() returns the graph of a
+    network, parsing it on a miss only, and must be paired with release().
+    Evicted graphs are closed once the last job using them releases them.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._graphs = OrderedDict()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(network):
+        if isinstance(network, str):
+            network = network.encode('utf8')
+        return hashlib.sha256(network).hexdigest()
+
+    def get(self, network):
+        key = self.key(network)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None:
+                self.hits += 1
+                self._graphs.move_to_end(key)
+                self._users[graph] += 1
+                return graph
+            self.misses += 1
+        graph = parse_network(network)
+        graph.key = key
+        graph.share()
+        with self._lock:
+            if key in self._graphs:
+                # Parsed by another job meanwhile
+                graph.close()
+                graph = self._graphs[key]
+                self._users[graph] += 1
+                return graph
+            self._graphs[key] = graph
+            self._users[graph] = 1
+            self._evict()
+        return graph
+
+    def release(self, graph):
+        with self._lock:
+            self._users[graph] -= 1
+            if not self._users[graph] and self._graphs.get(graph.key) is not graph:
+                del self._users[graph]
+                graph.close()
+
+    def _evict(self):
+        size = sum(graph.nbytes() for graph in self._graphs.values())
+        # Keep the newest graph even if it alone exceeds the budget
+        while size > self.max_bytes and len(self._graphs) > 1:
+            key, graph = self._graphs.popitem(last=False)
+            size -= graph.nbytes()
+            if not self._users[graph]:
+                del self._users[graph]
+                graph.close()
+
+    def clear(self):
+        '''
+        Closes every graph, including those still in use.
+        '''
+        with self._lock:
+            for graph in self._users:
+                graph.close()
+            self._graphs.clear()
+            self._users.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'graphs': len(self._graphs),
+                'bytes': sum(graph.nbytes() for graph in self._graphs.values())
+            }
+
+network_cache = NetworkCache(256 * 1024 * 1024)
+# Child processes leave through os._exit() and do not run this
+atexit.register(network_cache.clear)
+
+class ScoreCache(object):
+    '''
+    Scoring reports by score key, see key(). The newest memory_entries are
+    kept in memory and, when path is set, the newest disk_entries in an
+    SQLite database at path, both evicting the least recently used.
+    '''
+    # Bumped whenever the samples drawn for a score change, so that scores
+    # kept on disk from other samples are not served
+    version = 1
+
+    def __init__(self, memory_entries=4096, path=None, disk_entries=100000):
+        self.memory_entries = memory_entries
+        self.path = path
+        self.disk_entries = disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._reports = OrderedDict()
+        self._db = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(graph, model, engine, seeds, random_seed, *options):
+        '''
+        Key of a score: versions of the sampling, network, model, engine, the
+        seed set sorted by id, random seed and the sampling options.
+        '''
+        seeds = sorted(graph.ids[seeds].tolist())
+        key = json.dumps([ScoreCache.version, LiveEdgeIndex.version, SAMPLE_BLOCK, graph.key, model, engine, seeds,
+                          str(random_seed)] + list(options))
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+    def _connect(self):
+        if self._db is None and self.path is not None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, report TEXT, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS scores_used ON scores (used)')
+        return self._db
+
+    def get(self, key):
+        with self._lock:
+            report = self._reports.get(key)
+            if report is not None:
+                self._reports.move_to_end(key)
+            elif self._connect() is not None:
+                row = self._db.execute('SELECT report FROM scores WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    report = json.loads(row[0])
+                    self._db.execute('UPDATE scores SET used = ? WHERE key = ?', (time.time(), key))
+                    self._db.commit()
+                    self._remember(key, report)
+            if report is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(report)
+
+    def put(self, key, report):
+        with self._lock:
+            self._remember(key, report)
+            if self._connect() is not None:
+                self._db.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)', (key, json.dumps(report), time.time()))
+                self._db.execute('DELETE FROM scores WHERE key IN '
+                                 '(SELECT key FROM scores ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.disk_entries,))
+                self._db.commit()
+
+    def _remember(self, key, report):
+        self._reports[key] = report
+        self._reports.move_to_end(key)
+        while len(self._reports) > self.memory_entries:
+            self._reports.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'memory': len(self._reports)}
+
+score_cache = ScoreCache()
+
 def read_seed (fd, seed_count, graph):
     seeds = []
+    reason = None
     lines = fd.readlines()
     for line in lines:
         if line:
             try:
-                seeds.append(graph.map[int(line)])
+                seeds.append(int(line))
             except ValueError:
-                err = SolutionError()
-                err.set_reason("Vaule Error! Not int.")
-                raise err
-            except KeyError:
-                err = SolutionError()
-                err.set_reason("Node not in the network.")
-                raise err
+                reason = "Vaule Error! Not int."
+                break
+            if not -2 ** 63 <= seeds[-1] < 2 ** 63:
+                seeds.pop()
+                reason = "Node not in the network."
+                break
+    # Ids are looked up together, a missing id before the line that ended
+    # the loop is still reported first
+    seeds, missing = graph.index(seeds)
+    if missing.any():
+        reason = "Node not in the network."
+    if reason is not None:
+        err = SolutionError()
+        err.set_reason(reason)
+        raise err
     if len(seeds) != seed_count:
         err = SolutionError()
         err.set_reason("Wrong number of seeds")
         raise err
-    return seeds
+    return seeds.tolist()
 
 def chunks(arr, m):
     n = int(math.ceil(len(arr) / float(m)))
@@ -199,40 +1128,197 @@ def chunks(arr, m):
 
 def activate(verties, status):
     if isinstance(verties, int):
-        status[verties] = True
+        status[verties] = ACTIVE
     else:
         for vertex in verties:
-            status[vertex] = True
+            status[vertex] = ACTIVE
 
 def inactivate(verties, status):
     if isinstance(verties, int):
-        status[verties] = False
+        status[verties] = INACTIVE
     else:
         for vertex in verties:
-            status[vertex] = False
+            status[vertex] = INACTIVE
+
+_pool = None
+
+def start_pool(processes=None, cpus=None):
+    '''
+    Starts the scoring pool shared by every estimate_async() call of this
+    process. processes is the number of cores scoring may use at once and
+    defaults to the number of cores, cpus the CPUs its workers are pinned
+    to if given. Starting a started pool does nothing.
+    '''
+    global _pool
+    if _pool is None:
+        processes = processes or mp.cpu_count()
+        initializer = os.sched_setaffinity if cpus else None
+        _pool = ProcessPoolExecutor(max_workers=processes, initializer=initializer, initargs=(0, cpus))
+        # Fork all workers now rather than while judging the first case
+        for future in [_pool.submit(time.sleep, 0.1) for i in range(processes)]:
+            future.result()
+    return _pool
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
 
-async def estimate_async(network, seeds, seed_count, model='IC', multiprocess=8, random_seed='88010123'):
-    # Can set executor to None if a default has been set for loop
+def pool_sample(graph, type, engine, seeds, r, random_seed, index=None, start=0, breakdown=False):
+    '''
+    Draws r samples in a scoring pool worker and returns their moments().
+    '''
+    sampler = Sampler(graph, type, None, None, random_seed, engine, index)
+    sampler.prepare()
+    return sampler.moments(seeds, r, start, breakdown)
+
+async def _acquire(loop, function, release, *args):
+    '''
+    Returns function(*args) run in the default executor, a reference to be
+    given back with release(). If the caller is cancelled meanwhile, the
+    reference is given back once function returns.
+    '''
+    future = loop.run_in_executor(None, function, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        def give_back(future):
+            if not future.cancelled() and future.exception() is None:
+                release(future.result())
+        future.add_done_callback(give_back)
+        raise
+
+async def estimate_async(network, seeds, seed_count, model='IC', multiprocess=8, random_seed='88010123', engine='python',
+                         r=10000, tolerance=None, rel_tolerance=None, r_min=1000, r_max=100000, confidence=0.95,
+                         report=False, cache=True, progress=None, breakdown=False):
+    '''
+    Same as estimate(), but the samples are drawn by the scoring pool (see
+    start_pool()) in chunks, at most multiprocess of them queued or running
+    at a time so that chunks of concurrent cases interleave.
+
+    Cancelling the task awaiting it drops the queued chunks, so the pool is
+    free again once the running ones end.
+    '''
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine: ' + engine)
+    if breakdown and engine != 'index':
+        raise ValueError('Seed breakdown needs the index engine')
     loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(ProcessPoolExecutor(), estimate, network, seeds, seed_count, model, multiprocess, random_seed)
-    return result
+    pool = start_pool()
+    graph = await _acquire(loop, network_cache.get, network_cache.release, network)
+    index = None
+    try:
+        seeds = read_seed(io.StringIO(seeds), seed_count, graph)
+        if not is_adaptive(tolerance, rel_tolerance):
+            r_min = r_max = r
+        engine, breakdown = index_engine(graph, engine, r_max, breakdown)
+        key = ScoreCache.key(graph, model, engine, seeds, random_seed, tolerance, rel_tolerance, r_min, r_max, confidence,
+                             breakdown)
+        # SQLite queries off the event loop
+        result = await loop.run_in_executor(None, score_cache.get, key) if cache else None
+        if result is not None:
+            result['cached'] = True
+            return result if report else result['influence']
+        if engine == 'index':
+            index = await loop.run_in_executor(pool, load_index, graph, model, r_max, random_seed)
+            use_index(index)
+            await loop.run_in_executor(None, evict_indexes)
+        estimation = Estimation(confidence)
+        remaining = estimation.remaining(tolerance, rel_tolerance, r_min, r_max)
+        while remaining:
+            work = chunk_work(estimation.count, remaining)
+            running = set()
+            try:
+                while work or running:
+                    while work and len(running) < multiprocess:
+                        start, count = work.pop(0)
+                        running.add(loop.run_in_executor(pool, pool_sample, graph, model, engine, seeds,
+                                                         count, random_seed, index, start, breakdown))
+                    done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        estimation.merge(*future.result())
+                    if progress is not None:
+                        progress(estimation.count, r_max)
+            finally:
+                # Chunks not started yet are removed from the pool's queue
+                for future in running:
+                    future.cancel()
+            remaining = estimation.remaining(tolerance, rel_tolerance, r_min, r_max)
+        result = estimation.report()
+        if breakdown:
+            result['breakdown'] = estimation.breakdown(graph.ids[numpy.unique(seeds)].tolist())
+        await loop.run_in_executor(None, score_cache.put, key, result)
+        result['cached'] = False
+        return result if report else result['influence']
+    finally:
+        if index is not None:
+            release_index(index)
+        network_cache.release(graph)
 
-def estimate(network, seeds, seed_count, model='IC', multiprocess=2, random_seed='sustech'):
+def estimate(network, seeds, seed_count, model='IC', multiprocess=2, random_seed='sustech', engine='python',
+             r=10000, tolerance=None, rel_tolerance=None, r_min=1000, r_max=100000, confidence=0.95,
+             report=False, cache=True, progress=None, breakdown=False):
     '''
     network: string
     seeds: string
+    engine: 'python' samples one cascade at a time, 'numpy' runs batches of
+            cascades with BatchSampler, 'index' traverses the samples of a
+            LiveEdgeIndex of the network, built once per network, model
+            and random_seed, so all seed sets are scored on the same samples,
+            or 'numpy' if the index would exceed INDEX_MAX_BYTES
+    r: number of samples
+    tolerance, rel_tolerance: if either is given, samples are drawn in rounds
+            until the half-width of the confidence interval is at most
+            tolerance, or rel_tolerance times the influence, using between
+            r_min and r_max samples instead of r
+    report: return a dict with the influence, number of samples,
+            confidence interval and whether it came from score_cache
+            instead of the influence only
+    cache: look the score up in score_cache before sampling
+    progress: called with the number of samples done and the most that
+            may be drawn after every chunk, it may raise to stop scoring
+    breakdown: with the 'index' engine, add to the report the influence of
+            every seed on its own, its marginal influence which no other
+            seed reaches, and its overlap with the others, all from the
+            samples of the score
     '''
-    networkio = io.StringIO(network)
     seedsio = io.StringIO(seeds)
-    random.seed(random_seed)
-    graph = read_network(networkio)
-    seeds = read_seed(seedsio, seed_count, graph)
-    r = 10000
-    workstation = ISE(graph, model, multiprocess)
-    workstation.start_simpler()
-    workstation.Testing(seeds, r)
-    result = workstation.finish()
-    return result
+    graph = network_cache.get(network)
+    index = None
+    try:
+        seeds = read_seed(seedsio, seed_count, graph)
+        if not is_adaptive(tolerance, rel_tolerance):
+            r_min = r_max = r
+        engine, breakdown = index_engine(graph, engine, r_max, breakdown)
+        key = ScoreCache.key(graph, model, engine, seeds, random_seed, tolerance, rel_tolerance, r_min, r_max, confidence,
+                             breakdown)
+        result = score_cache.get(key) if cache else None
+        if result is not None:
+            result['cached'] = True
+            return result if report else result['influence']
+        if engine == 'index':
+            index = load_index(graph, model, r_max, random_seed)
+            use_index(index)
+            evict_indexes()
+        workstation = ISE(graph, model, multiprocess, engine, index, random_seed, breakdown)
+        workstation.start_simpler()
+        try:
+            workstation.Testing(seeds, r_min, tolerance, rel_tolerance, r_max, confidence, progress)
+        except BaseException:
+            workstation.cancel()
+            raise
+        workstation.finish()
+    finally:
+        if index is not None:
+            release_index(index)
+        network_cache.release(graph)
+    result = workstation.estimation.report()
+    if breakdown:
+        result['breakdown'] = workstation.estimation.breakdown(graph.ids[numpy.unique(seeds)].tolist())
+    score_cache.put(key, result)
+    result['cached'] = False
+    return result if report else result['influence']
 
 class SolutionError(Exception):
     def __init__(self):
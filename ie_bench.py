@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of influence estimation on reproducible synthetic networks.
+
+    python3 ie_bench.py --sizes small,medium --output bench.json
+    python3 ie_bench.py --output new.json --compare bench.json --threshold 0.2
+
+Times parsing, IC and LT sampling throughput of every engine, and end-to-end
+estimate() for several multiprocess values. With --compare, metrics worse
+than the given run by more than the threshold are reported and the exit code
+is 1.
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy
+
+import ie
+
+SIZES = {
+    'small': (1000, 5000),
+    'medium': (10000, 100000),
+    'large': (100000, 1000000),
+}
+
+# Metrics where a larger value is better, all others are times
+THROUGHPUT_SUFFIX = 'samples_per_sec'
+
+
+def generate_network(kind='er', vertices=1000, edges=5000, weights='wc', seed=0):
+    '''
+    Returns the text of a random network.
+
+    kind: 'er' picks both ends of every edge uniformly (Erdos-Renyi),
+          'powerlaw' picks them with probability following a power law of
+          exponent 2.5 (Chung-Lu), giving a few hubs
+    weights: 'wc' weighted cascade 1 / in-degree, valid for LT as well,
+             'trivalency' one of 0.1, 0.01 and 0.001, 'uniform' in [0, 0.1)
+    '''
+    rng = numpy.random.default_rng(seed)
+    if kind == 'er':
+        source = rng.integers(0, vertices, edges)
+        target = rng.integers(0, vertices, edges)
+    elif kind == 'powerlaw':
+        p = (numpy.arange(vertices) + 1.) ** (-1 / (2.5 - 1))
+        p /= p.sum()
+        source = rng.choice(vertices, edges, p=p)
+        target = rng.permutation(vertices)[rng.choice(vertices, edges, p=p)]
+    else:
+        raise ValueError('Unknown network kind: ' + kind)
+    if weights == 'wc':
+        weight = 1. / numpy.bincount(target, minlength=vertices)[target]
+    elif weights == 'trivalency':
+        weight = rng.choice([0.1, 0.01, 0.001], edges)
+    elif weights == 'uniform':
+        weight = rng.random(edges) * 0.1
+    else:
+        raise ValueError('Unknown weights: ' + weights)
+    # Ids start from 1 as in the example networks
+    lines = ['{} {}'.format(vertices, edges)]
+    lines += ['{} {} {:.6f}'.format(vi + 1, vj + 1, w) for vi, vj, w in zip(source, target, weight)]
+    return '\n'.join(lines) + '\n'
+
+
+def generate_seeds(network, count):
+    '''
+    Returns the text of the count vertices with the most out-edges.
+    '''
+    graph = ie.parse_network(network)
+    top = numpy.argsort(-graph.out_degree(), kind='stable')[:count]
+    return '\n'.join(str(vertex) for vertex in graph.ids[top]) + '\n'
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_sampling(graph, seeds, model, engine, samples):
+    sampler = ie.Sampler(graph, model, None, None, 0, engine)
+    sampler.prepare()
+    elapsed, result = timed(sampler.single_sample, seeds, samples)
+    return samples / elapsed
+
+
+def run(sizes, kinds, weights, engines, multiprocess, samples, seed_count):
+    results = {}
+    for size in sizes:
+        vertices, edges = SIZES[size]
+        for kind in kinds:
+            for weight in weights:
+                name = '{}.{}.{}'.format(size, kind, weight)
+                print('Generating ' + name, file=sys.stderr)
+                network = generate_network(kind, vertices, edges, weight)
+                seeds = generate_seeds(network, seed_count)
+                elapsed, graph = timed(ie.parse_network, network)
+                results[name + '.parse_sec'] = elapsed
+                seed_index = graph.index([int(line) for line in seeds.split()])[0].tolist()
+                for model in ('IC', 'LT'):
+                    for engine in engines:
+                        key = '{}.{}.{}.{}'.format(name, model, engine, THROUGHPUT_SUFFIX)
+                        results[key] = bench_sampling(graph, seed_index, model, engine, samples)
+                        print('{} {:.1f}'.format(key, results[key]), file=sys.stderr)
+                    for processes in multiprocess:
+                        # Start from an empty cache, as for a new network
+                        ie.network_cache.clear()
+                        key = '{}.{}.estimate.mp{}.sec'.format(name, model, processes)
+                        results[key] = timed(ie.estimate, network, seeds, seed_count, model=model,
+                                             multiprocess=processes, r=samples, cache=False)[0]
+                        print('{} {:.3f}'.format(key, results[key]), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Returns (metric, baseline value, value, relative change) of every metric
+    worse than in baseline by more than threshold.
+    '''
+    regressions = []
+    for key, value in sorted(results.items()):
+        if key not in baseline or not baseline[key]:
+            continue
+        old = baseline[key]
+        if key.endswith(THROUGHPUT_SUFFIX):
+            change = (old - value) / old
+        else:
+            change = (value - old) / old
+        if change > threshold:
+            regressions.append((key, old, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark influence estimation')
+    parser.add_argument('--sizes', default='small', help='comma separated of ' + ', '.join(SIZES))
+    parser.add_argument('--kinds', default='er,powerlaw')
+    parser.add_argument('--weights', default='wc,trivalency')
+    parser.add_argument('--engines', default='python,numpy')
+    parser.add_argument('--multiprocess', default='1,2,4')
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--seed-count', type=int, default=10)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as regression')
+    args = parser.parse_args(argv)
+    results = run(args.sizes.split(','), args.kinds.split(','), args.weights.split(','),
+                  args.engines.split(','), [int(n) for n in args.multiprocess.split(',')],
+                  args.samples, args.seed_count)
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.machine(),
+            'samples': args.samples,
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new, change in regressions:
+            print('REGRESSION {}: {:.4g} -> {:.4g} ({:+.1%})'.format(key, old, new, change))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,18 @@
-import json
 import logging
 import coloredlogs
 import asyncio
 import aiohttp
-import base64
 import websockets
 import config
 import traceback
 import time
+import ie
+from concurrent.futures import ThreadPoolExecutor
 from msg_types import *
-from case import CARPCase
+from case import CARPCase, docker_client, data_cache, container_pool, cpu_allocator
+from scheduler import Scheduler, host_capacity
+from metrics import registry, phase_seconds, queue_depth
+from protocol import JsonCodec, subprotocols, get_codec, case_archive
 from errors import *
 
 coloredlogs.install(level=config.log_level)
@@ -17,105 +20,253 @@ coloredlogs.install(level=config.log_level)
 send_queue = asyncio.Queue()
 receive_queue = asyncio.Queue()
 judge_queue = asyncio.Queue()
+# Prepared cases waiting for a judge worker, and run IMP cases waiting for scoring
+ready_queue = asyncio.Queue(maxsize=config.prepare_ahead)
+score_queue = asyncio.Queue()
+
+prepare_executor = ThreadPoolExecutor(config.prepare_tasks)
+
+# CPUs and memory for containers, the rest is kept for scoring
+judge_cpus, judge_memory = host_capacity(config.scoring_processes, config.scoring_memory)
+scheduler = Scheduler(config.judge_cpus or judge_cpus, config.judge_memory or judge_memory,
+                      config.admission_max_wait)
+
+for name, queue in (('send', send_queue), ('receive', receive_queue), ('judge', judge_queue),
+                    ('ready', ready_queue), ('score', score_queue)):
+    queue_depth.set_function(queue.qsize, name)
 
 uid = None
+# Codec of the protocol negotiated with the server
+codec = JsonCodec
+
+
+def __send(obj):
+    '''
+    Queues a message for the server, with the time it was queued at. It is
+    encoded when sent, with the codec of the connection at that time.
+    '''
+    send_queue.put_nowait((time.monotonic(), obj))
 
 
 async def __message_handler():
     while True:
         message = await receive_queue.get()
         try:
-            obj = json.loads(message)
+            obj = codec.decode(message)
             type = obj['type']
             if type == CASE_DATA:
                 await judge_queue.put(obj['payload'])
             elif type == WORKER_TICK:
                 obj = {'type': WORKER_TICK}
-                await send_queue.put(json.dumps(obj))
+                __send(obj)
             elif type == WORKER_INFO:
                 obj = {'uid': uid, 'type': WORKER_INFO, 'maxTasks': config.parallel_judge_tasks}
-                await send_queue.put(json.dumps(obj))
+                obj.update(scheduler.stats())
+                __send(obj)
         except Exception as e:
             logging.error(e)
 
 
-async def __judge_worker(idx):
+def __progress_sender(cid):
+    '''
+    Returns a scoring progress callback queueing a CASE_PROGRESS message at
+    most every config.progress_interval seconds.
+    '''
+    last = 0.
+
+    def progress(done, total):
+        nonlocal last
+        now = time.time()
+        if now - last < config.progress_interval and done < total:
+            return
+        last = now
+        obj = {
+            'type': CASE_PROGRESS,
+            'cid': cid,
+            'done': done,
+            'total': total,
+            'timestamp': now
+        }
+        __send(obj)
+    return progress
+
+
+def __prepare_case(obj):
+    '''
+    Decodes a case and extracts its workspace, in a thread of
+    prepare_executor.
+    '''
+    start = time.monotonic()
+    data = case_archive(obj)
+    case = CARPCase(data, obj['cid'], obj['type'], obj['dataset'])
+    case.timings.add('decode', time.monotonic() - start)
+    try:
+        with case.timings.phase('extract'):
+            return case.__enter__()
+    except BaseException:
+        case.close()
+        raise
+
+
+def __close_prepared(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+async def __send_error(idx, cid, e):
+    if isinstance(e, ArchiveError):
+        logging.error('[{}] {}'.format(idx, e))
+        return
+    logging.error('[{}] {}'.format(idx, e))
+    traceback.print_exc()
+    ret = {
+        'cid': cid,
+        'type': CASE_ERROR,
+        'message': str(e)
+    }
+    __send(ret)
+
+
+async def __case_preparer(idx):
+    '''
+    First stage of judging: prepares cases from judge_queue off the event
+    loop, up to config.prepare_ahead of them ahead of the judge workers.
+    '''
     while True:
         obj = await judge_queue.get()
         cid = ''
         try:
             cid = obj['cid']
-            data = base64.b64decode(obj['data'])
-            ctype = obj['type']
-            dataset = obj['dataset']
             logging.info('Enter judge for id: ' + cid)
-            with CARPCase(data, cid, ctype, dataset) as case:
+            future = prepare_executor.submit(__prepare_case, obj)
+            try:
+                case = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                future.add_done_callback(__close_prepared)
+                raise
+        except Exception as e:
+            await __send_error(idx, cid, e)
+            continue
+        try:
+            await ready_queue.put(case)
+        except asyncio.CancelledError:
+            case.close()
+            raise
+
+
+async def __judge_worker(idx):
+    '''
+    Second stage of judging: runs prepared cases once the scheduler admits
+    them, then hands IMP cases to the score workers and sends the result of
+    the others.
+    '''
+    while True:
+        case = await ready_queue.get()
+        cid = case.cid
+        scoring = False
+        try:
+            queued = time.monotonic()
+            # Pinned containers take whole CPUs
+            cpus = case.cpu_count if config.cpu_pinning else case.cpu
+            async with scheduler.admit(cpus, case.memory):
+                case.timings.add('admission', time.monotonic() - queued)
                 logging.info('[{}]({}) Start judge'.format(idx, cid))
                 obj = {
                     'type': CASE_START,
                     'cid': cid,
                     'timestamp': time.time()
                 }
-                await send_queue.put(json.dumps(obj))
-                timedout, stdout, stderr, exitcode = await case.run(stdout=True, stderr=True)
-                logging.info('[{}]({}) Judge finished: {}, {}'.format(idx, cid, timedout, exitcode))
-                stdout_overflow = False
-                stderr_overflow = False
-                stdout = stdout.decode('utf8')
-                stderr = stderr.decode('utf8')
-                finish_time = time.time()
-                if len(stdout) > config.log_limit_bytes:
-                    stdout = stdout[-config.log_limit_bytes:]
-                    stdout_overflow = True
-                if len(stderr) > config.log_limit_bytes:
-                    stderr = stderr[-config.log_limit_bytes:]
-                    stderr_overflow = True
-                if ctype == IMP:
-                    valid, influence, reason = await case.check_imp_result()
-                else:
-                    valid = False
-                    influence = 0.
-                    reason = ''
-                ret = {
-                    'cid': cid,
-                    'type': CASE_RESULT,
-                    'timedout': timedout,
-                    'stdout': stdout,
-                    'stdout_overflow': stdout_overflow,
-                    'stderr': stderr,
-                    'stderr_overflow': stderr_overflow,
-                    'exitcode': exitcode,
-                    'timestamp': finish_time,
-                    'valid': valid,
-                    'influence': influence,
-                    'reason': reason
-                }
-                await send_queue.put(json.dumps(ret))
-        except ArchiveError as e:
-            logging.error('[{}] {}'.format(idx, e))
-        except Exception as e:
-            logging.error('[{}] {}'.format(idx, e))
-            traceback.print_exc()
+                __send(obj)
+                timedout, stdout, stderr, exitcode = await case.run(stdout=True, stderr=True,
+                                                                    log_limit=config.log_limit_bytes,
+                                                                    flood_bytes=config.log_flood_bytes,
+                                                                    flood_rate=config.log_flood_rate)
+            logging.info('[{}]({}) Judge finished: {}, {}'.format(idx, cid, timedout, exitcode))
+            # Cutting the head and tail may split a character
+            stdout = stdout.decode('utf8', 'replace')
+            stderr = stderr.decode('utf8', 'replace')
+            finish_time = time.time()
             ret = {
                 'cid': cid,
-                'type': CASE_ERROR,
-                'message': str(e)
+                'type': CASE_RESULT,
+                'timedout': timedout,
+                'stdout': stdout,
+                'stdout_overflow': case.stdout_overflow,
+                'stderr': stderr,
+                'stderr_overflow': case.stderr_overflow,
+                'flooded': case.flooded,
+                'cpu_user': case.usage['cpu_user'],
+                'cpu_system': case.usage['cpu_system'],
+                'wall_time': case.usage['wall_time'],
+                'peak_memory': case.usage['peak_memory'],
+                'oom_killed': case.usage['oom_killed'],
+                'exitcode': exitcode,
+                'timestamp': finish_time,
+                'valid': False,
+                'influence': 0.,
+                'reason': ''
             }
-            await send_queue.put(json.dumps(ret))
+            if case.ctype == IMP:
+                await score_queue.put((case, ret))
+                scoring = True
+            else:
+                if config.report_timings:
+                    ret['timings'] = case.timings.phases
+                __send(ret)
+        except Exception as e:
+            await __send_error(idx, cid, e)
+        finally:
+            if not scoring:
+                case.close()
+
+
+async def __score_worker(idx):
+    '''
+    Third stage of judging: scores IMP cases and sends their result.
+    '''
+    while True:
+        case, ret = await score_queue.get()
+        cid = case.cid
+        try:
+            progress = None
+            if config.progress_interval is not None:
+                progress = __progress_sender(cid)
+            with case.timings.phase('scoring'):
+                valid, influence, reason = await case.check_imp_result(engine=config.scoring_engine,
+                                                                       progress=progress,
+                                                                       **config.scoring_options)
+            logging.debug('[{}]({}) Network cache: {}, score cache: {}'.format(idx, cid, ie.network_cache.stats(),
+                                                                                ie.score_cache.stats()))
+            ret['valid'] = valid
+            ret['influence'] = influence
+            ret['reason'] = reason
+            if case.imp_report:
+                ret['samples'] = case.imp_report['samples']
+                ret['interval'] = case.imp_report['interval']
+                ret['cached'] = case.imp_report['cached']
+                if 'breakdown' in case.imp_report:
+                    ret['breakdown'] = case.imp_report['breakdown']
+            if config.report_timings:
+                ret['timings'] = case.timings.phases
+            __send(ret)
+        except Exception as e:
+            await __send_error(idx, cid, e)
+        finally:
+            case.close()
 
 
 async def __message_dispatcher(ws):
     while True:
-        message = await send_queue.get()
-        await ws.send(message)
+        queued, obj = await send_queue.get()
+        phase_seconds.observe(time.monotonic() - queued, 'send')
+        await ws.send(codec.encode(obj))
 
 
 async def __tick_sender(ws):
     obj = {'type': WORKER_TICK, 'uid': uid}
-    data = json.dumps(obj)
     while True:
         await asyncio.sleep(60)
-        await send_queue.put(data)
+        __send(obj)
 
 
 async def __message_receiver(ws):
@@ -124,7 +275,7 @@ async def __message_receiver(ws):
 
 
 async def main():
-    global uid
+    global uid, codec
     while True:
         try:
             uid = None
@@ -165,16 +316,23 @@ async def main():
             logging.info('Cookie: ' + cookie)
             logging.info('Connecting to ' + config.websocket_url)
             headers = {'Cookie': cookie}
-            async with websockets.connect(config.websocket_url, extra_headers=headers, max_size=2 ** 24) as ws:
-                logging.info('Connected')
+            async with websockets.connect(config.websocket_url, extra_headers=headers, max_size=2 ** 24,
+                                          subprotocols=subprotocols(config.binary_protocol),
+                                          compression=config.websocket_compression) as ws:
+                codec = get_codec(ws.subprotocol)
+                logging.info('Connected, {} messages'.format('msgpack' if codec.binary else 'JSON'))
                 # Create tasks
                 handler_task = asyncio.ensure_future(__message_handler())
                 dispatcher_task = asyncio.ensure_future(__message_dispatcher(ws))
                 receiver_task = asyncio.ensure_future(__message_receiver(ws))
                 tick_task = asyncio.ensure_future(__tick_sender(ws))
                 judge_tasks = []
+                for i in range(config.prepare_tasks):
+                    judge_tasks.append(asyncio.ensure_future(__case_preparer(i)))
                 for i in range(config.parallel_judge_tasks):
                     judge_tasks.append(asyncio.ensure_future(__judge_worker(i)))
+                for i in range(config.scoring_tasks):
+                    judge_tasks.append(asyncio.ensure_future(__score_worker(i)))
                 # asyncio.get_event_loop().create_task(__fake_server())
                 done, pending = await asyncio.wait(
                     [handler_task, dispatcher_task, receiver_task, tick_task] + judge_tasks,
@@ -191,4 +349,32 @@ async def main():
 
 
 if __name__ == '__main__':
-    asyncio.get_event_loop().run_until_complete(main())
+    data_cache.max_bytes = config.data_cache_bytes
+    container_pool.shapes = config.container_pool
+    ie.network_cache.max_bytes = config.network_cache_bytes
+    ie.INDEX_DIR = config.index_dir
+    ie.INDEX_MAX_BYTES = config.index_max_bytes
+    ie.score_cache.path = config.score_cache_path
+    ie.score_cache.disk_entries = config.score_cache_entries
+    scoring_cpus = None
+    if config.cpu_pinning:
+        cpu_allocator.discover()
+        scoring_cpus = cpu_allocator.allocate(config.scoring_processes)
+    ie.start_pool(config.scoring_processes, scoring_cpus)
+    loop = asyncio.get_event_loop()
+    metrics_runner = None
+    try:
+        if config.metrics_port is not None:
+            try:
+                metrics_runner = loop.run_until_complete(registry.serve(config.metrics_host, config.metrics_port))
+            except OSError as e:
+                logging.error('Serving metrics at {}:{} failed, running without: {}'.format(
+                    config.metrics_host, config.metrics_port, e))
+        loop.run_until_complete(container_pool.fill())
+        loop.run_until_complete(main())
+    finally:
+        if metrics_runner is not None:
+            loop.run_until_complete(metrics_runner.cleanup())
+        loop.run_until_complete(container_pool.close())
+        loop.run_until_complete(docker_client.close())
+        ie.shutdown_pool()
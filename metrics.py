@@ -0,0 +1,130 @@
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Histogram:
+    '''
+    Prometheus histogram, with one series per value of its labels.
+    '''
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        counts, total = self._series.get(labels, ([0] * len(self.buckets), 0.))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._series[labels] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for labels, (counts, total) in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, labels, [('le', _number(bound))]),
+                                                     count))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, labels), _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, labels), counts[-1]))
+        return lines
+
+
+class Gauge:
+    '''
+    Prometheus gauge, with one series per value of its labels. Series given
+    a function are sampled when rendered.
+    '''
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+
+    def set(self, value, *labels):
+        self._series[labels] = value
+
+    def set_function(self, function, *labels):
+        self._series[labels] = function
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} gauge'.format(self.name)]
+        for labels, value in sorted(self._series.items(), key=lambda item: item[0]):
+            if callable(value):
+                value = value()
+            lines.append('{}{} {}'.format(self.name, _labels(self.labels, labels), _number(value)))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host='127.0.0.1', port=9100):
+        '''
+        Serves the metrics in Prometheus text format at /metrics, returns
+        the aiohttp runner to clean up.
+        '''
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain',
+                                headers={'X-Prometheus-Format': '0.0.4'})
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+registry = Registry()
+phase_seconds = registry.register(Histogram('carp_judge_phase_seconds', 'Time spent in each phase of a case',
+                                            ('phase',)))
+queue_depth = registry.register(Gauge('carp_judge_queue_depth', 'Messages or cases waiting in a queue', ('queue',)))
+
+
+class Timings:
+    '''
+    Monotonic durations of the phases of one case, also observed in
+    phase_seconds.
+    '''
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.) + seconds
+        phase_seconds.observe(seconds, phase)
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
@@ -4,6 +4,7 @@ CASE_DATA = 2
 CASE_START = 3
 CASE_RESULT = 4
 CASE_ERROR = 5
+CASE_PROGRESS = 6
 
 INVALID = -1
 CARP = 0
@@ -0,0 +1,66 @@
+import json
+import base64
+import msgpack
+
+# WebSocket subprotocol of msgpack messages in binary frames
+MSGPACK_PROTOCOL = 'carp-judge.msgpack'
+
+
+class JsonCodec:
+    '''
+    The original protocol: JSON messages in text frames, the archive of a
+    case base64 encoded in its data.
+    '''
+    binary = False
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj)
+
+    @staticmethod
+    def decode(message):
+        return json.loads(message)
+
+
+class MsgpackCodec:
+    '''
+    Messages as msgpack maps in binary frames, with the same fields as the
+    JSON ones except that bytes, such as the archive of a case, are carried
+    raw. Text frames are still read as JSON.
+    '''
+    binary = True
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def decode(message):
+        if isinstance(message, str):
+            return json.loads(message)
+        return msgpack.unpackb(message, raw=False)
+
+
+def subprotocols(binary=True):
+    '''
+    Returns the subprotocols to offer when connecting, None for JSON only.
+    '''
+    return [MSGPACK_PROTOCOL] if binary else None
+
+
+def get_codec(subprotocol):
+    '''
+    Returns the codec of the subprotocol the server chose, JSON if none.
+    '''
+    return MsgpackCodec if subprotocol == MSGPACK_PROTOCOL else JsonCodec
+
+
+def case_archive(payload):
+    '''
+    Returns the archive of a CASE_DATA payload, raw with msgpack and base64
+    encoded with JSON.
+    '''
+    data = payload['data']
+    if isinstance(data, str):
+        return base64.b64decode(data)
+    return bytes(data)
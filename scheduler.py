@@ -0,0 +1,80 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+
+def host_capacity(reserve_cpus=0, reserve_memory=0):
+    '''
+    Returns (CPUs, memory in MB) of the host, less the given reserve.
+    '''
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    return max(cpus - reserve_cpus, 1), max(memory - reserve_memory, 1)
+
+
+class Scheduler:
+    '''
+    Admits cases when the CPUs and memory (MB) they declare fit in what is
+    free. Waiting cases are admitted in arrival order, but later ones that
+    fit backfill around one that does not, unless it has waited more than
+    max_wait seconds. Cases asking for more than there is in total are
+    admitted alone.
+    '''
+    def __init__(self, cpus, memory, max_wait=60):
+        self.cpus = cpus
+        self.memory = memory
+        self.max_wait = max_wait
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self._waiting = []
+
+    def _clamp(self, cpus, memory):
+        return min(cpus, self.cpus), min(memory, self.memory)
+
+    async def acquire(self, cpus, memory):
+        cpus, memory = self._clamp(cpus, memory)
+        loop = asyncio.get_event_loop()
+        waiter = (loop.time(), cpus, memory, loop.create_future())
+        self._waiting.append(waiter)
+        self._dispatch()
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            elif not waiter[3].cancelled():
+                # Admitted just before being cancelled
+                self.release(cpus, memory)
+            raise
+
+    def release(self, cpus, memory):
+        cpus, memory = self._clamp(cpus, memory)
+        self.free_cpus += cpus
+        self.free_memory += memory
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, cpus, memory):
+        await self.acquire(cpus, memory)
+        try:
+            yield
+        finally:
+            self.release(cpus, memory)
+
+    def _dispatch(self):
+        now = asyncio.get_event_loop().time()
+        for waiter in list(self._waiting):
+            arrival, cpus, memory, future = waiter
+            if future.done():
+                self._waiting.remove(waiter)
+            elif cpus <= self.free_cpus and memory <= self.free_memory:
+                self.free_cpus -= cpus
+                self.free_memory -= memory
+                self._waiting.remove(waiter)
+                future.set_result(None)
+            elif now - arrival > self.max_wait:
+                # Keep what is freed for it
+                break
+
+    def stats(self):
+        return {'freeCpu': self.free_cpus, 'freeMemory': self.free_memory, 'waiting': len(self._waiting)}